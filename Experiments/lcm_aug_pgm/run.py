@@ -87,11 +87,13 @@ df_res.to_csv("combining_pgm_w_lcm_results.csv")
 std_aug = []
 std_lcm = []
 for idx in df_est.index:
-    mg_0 = lcm.create_mgs(df_estimation=df_est.loc[mg.loc[idx]], k=1)
+    mg_0 = lcm.create_mgs(df_estimation=df_est.loc[mg.loc[idx]], k=1).to_frames(
+        return_original_idx=False)
     a = set(mg_0[0][0].loc[0]).union(mg_0[0][1].loc[0])
     df_est.loc[mg.loc[idx]].iloc[list(a)]
 
-    mg_1 = lcm.create_mgs(df_estimation=df_est, k=1)
+    mg_1 = lcm.create_mgs(df_estimation=df_est, k=1).to_frames(
+        return_original_idx=False)
     b = set(mg_1[0][0].loc[idx]).union(mg_1[0][1].loc[idx])
 
     std_aug.append(df_est.loc[mg.loc[idx]].iloc[list(a)].std().drop(["Y", "T"]).values)
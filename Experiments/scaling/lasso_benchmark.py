@@ -0,0 +1,41 @@
+"""Benchmark of learning the VIM_CF variable importances with one LassoCV per
+split against the Gram matrix cached GramLassoCV on the scaling dataset saved
+by create_dataset.py as the number of covariates grows. With fewer than 8
+samples per covariate, model='linear' also fits one LassoCV per split."""
+import os
+import numpy as np
+import pandas as pd
+import time
+from sklearn.linear_model import LassoCV
+
+from src.variable_imp_matching import VIM_CF
+
+data_folder = os.getenv('RESULTS_FOLDER')
+save_folder = os.getenv('SAVE_FOLDER')
+n_samples = int(os.getenv('N_SAMPLES', 4096))
+n_covs_list = [8, 32, 128, 512, 1024]
+
+df = pd.read_csv(f'{data_folder}/df.csv', nrows=n_samples)
+all_covs = [c for c in df.columns if c not in ['Y', 'T']]
+
+results = []
+for n_covs in n_covs_list:
+    lcm = VIM_CF(outcome='Y', treatment='T',
+                 data=df[[*all_covs[:n_covs], 'T', 'Y']], random_state=0)
+    start = time.time()
+    lcm.fit(model=LassoCV(max_iter=5000), model_weight_attr='coef_')
+    time_lassocv = time.time() - start
+    M_lassocv = lcm.M_list
+    start = time.time()
+    lcm.fit(model='linear')
+    time_gram = time.time() - start
+    max_diff = np.max([np.abs(m - m_ref).max() for m, m_ref in
+                       zip(lcm.M_list, M_lassocv)])
+    results.append({'n_covs': n_covs, 'time_lassocv': time_lassocv,
+                    'time_gram': time_gram, 'max_M_diff': max_diff})
+    print(f'p={n_covs}: LassoCV {time_lassocv:.2f}s, '
+          f'GramLassoCV {time_gram:.2f}s, max M diff {max_diff:.4f}')
+
+df_results = pd.DataFrame(results)
+if save_folder is not None:
+    df_results.to_csv(f'{save_folder}/lasso_benchmark.csv', index=False)
@@ -0,0 +1,46 @@
+"""Benchmark of creating match groups with the cityblock and the BLAS backed
+euclidean metrics on the scaling dataset saved by create_dataset.py as the
+number of covariates grows."""
+import os
+import numpy as np
+import pandas as pd
+import time
+
+from utils import get_match_groups
+
+data_folder = os.getenv('RESULTS_FOLDER')
+save_folder = os.getenv('SAVE_FOLDER')
+n_samples = int(os.getenv('N_SAMPLES', 4096))
+configs = [('sklearn', 'cityblock'), ('brute', 'cityblock'),
+           ('numba', 'cityblock'), ('sklearn', 'euclidean'),
+           ('brute', 'euclidean')]
+n_covs_list = [8, 32, 128, 512, 1024]
+k = 10
+n_repeats = 3
+
+df = pd.read_csv(f'{data_folder}/df.csv', nrows=n_samples)
+all_covs = [c for c in df.columns if c not in ['Y', 'T']]
+
+get_match_groups(df.iloc[:64], all_covs[:2], 'T', M=np.ones(2), k=k,
+                 nn_engine='numba')  # compile the numba kernel before timing
+
+results = []
+for n_covs in n_covs_list:
+    covariates = all_covs[:n_covs]
+    M = np.ones(n_covs)
+    for engine, metric in configs:
+        times = []
+        for _ in range(n_repeats):
+            start = time.time()
+            get_match_groups(df, covariates, 'T', M=M, k=k, nn_engine=engine,
+                             metric=metric)
+            times.append(time.time() - start)
+        results.append({'n_covs': n_covs, 'engine': f'{engine}_{metric}',
+                        'time': np.min(times)})
+        print(f'p={n_covs}, {engine}, {metric}: {np.min(times):.4f}s')
+
+df_results = pd.DataFrame(results).pivot_table(index='n_covs',
+                                               columns='engine', values='time')
+print(df_results)
+if save_folder is not None:
+    df_results.to_csv(f'{save_folder}/metric_benchmark.csv')
@@ -0,0 +1,40 @@
+"""Micro-benchmark of the nearest neighbor engines used to create match
+groups as the number of samples and (nonzero weight) covariates grow."""
+import os
+import numpy as np
+import pandas as pd
+import time
+
+from utils import get_nn
+
+save_folder = os.getenv('SAVE_FOLDER')
+engines = ['sklearn', 'brute', 'numba']
+n_samples_list = [1024, 4096, 16384]
+n_covs_list = [2, 8, 32, 128]
+k = 10
+n_repeats = 3
+
+rng = np.random.default_rng(0)
+get_nn(rng.normal(size=(64, 2)), np.zeros(64), treatment=0, k=k,
+       nn_engine='numba')  # compile the numba kernel before timing
+
+results = []
+for n_samples in n_samples_list:
+    for n_covs in n_covs_list:
+        X = rng.normal(size=(n_samples, n_covs))
+        T = rng.binomial(1, 0.5, size=n_samples)
+        for engine in engines:
+            times = []
+            for _ in range(n_repeats):
+                start = time.time()
+                get_nn(X, T, treatment=1, k=k, nn_engine=engine)
+                times.append(time.time() - start)
+            results.append({'n_samples': n_samples, 'n_covs': n_covs,
+                            'engine': engine, 'time': np.min(times)})
+            print(f'n={n_samples}, p={n_covs}, {engine}: {np.min(times):.4f}s')
+
+df_results = pd.DataFrame(results).pivot_table(
+    index=['n_samples', 'n_covs'], columns='engine', values='time')
+print(df_results)
+if save_folder is not None:
+    df_results.to_csv(f'{save_folder}/nn_benchmark.csv')
@@ -0,0 +1,70 @@
+"""Count how many matches change when the covariates are matched in float32
+or int8 instead of float64, on continuous data and on dummy encoded
+categorical data like the schools dataset."""
+import os
+import numpy as np
+import pandas as pd
+import time
+
+from Experiments.helpers import get_data
+from src.variable_imp_matching import VIM_CF
+from utils import get_match_groups, covariate_matrix
+
+save_folder = os.getenv('SAVE_FOLDER')
+n_samples = int(os.getenv('N_SAMPLES', 8192))
+k = 10
+
+df_cont, _, _ = get_data(data='dense_continuous',
+                         config={'num_samples': n_samples, 'imp_c': 8,
+                                 'unimp_c': 56, 'imp_d': 0, 'unimp_d': 0,
+                                 'n_train': 0})
+
+rng = np.random.default_rng(0)
+cats = pd.DataFrame({f'C{i}': rng.integers(0, 3 + i % 4, size=n_samples)
+                     for i in range(12)})
+df_dummy = pd.get_dummies(cats, columns=list(cats.columns)).astype(int)
+df_dummy['T'] = rng.binomial(1, 0.5, size=n_samples)
+df_dummy['Y'] = cats['C0'] + 2 * (cats['C1'] == 1) + \
+    df_dummy['T'] * cats['C2'] + rng.normal(size=n_samples)
+
+results = []
+for name, df, dtypes in [('continuous', df_cont, ['float32']),
+                         ('dummy', df_dummy, ['float32', 'int8'])]:
+    lcm = VIM_CF(outcome='Y', treatment='T', data=df, n_splits=2,
+                 random_state=0)
+    lcm.fit()
+    df_data = lcm.to_frame()
+    for i, (est_idx, _) in enumerate(lcm.split_strategy):
+        df_est = df_data.loc[est_idx]
+        start = time.time()
+        mgs_64 = get_match_groups(df_est, lcm.covariates, 'T',
+                                  M=lcm.M_list[i], k=k)
+        time_64 = time.time() - start
+        for dtype in dtypes:
+            start = time.time()
+            mgs = get_match_groups(df_est, lcm.covariates, 'T',
+                                   M=lcm.M_list[i], k=k, dtype=dtype)
+            this_time = time.time() - start
+            for t in mgs.treatment_classes:
+                same_set = [len(np.intersect1d(a, b)) for a, b in
+                            zip(mgs.groups[t], mgs_64.groups[t])]
+                results.append({
+                    'data': name, 'split': i, 'dtype': dtype, 'treatment': t,
+                    'frac_matches_changed': 1 - np.sum(same_set) /
+                    mgs.groups[t].size,
+                    'frac_samples_changed': np.mean(np.array(same_set) < k),
+                    'max_dist_diff': np.abs(mgs.distances[t] -
+                                            mgs_64.distances[t]).max(),
+                    'covariate_bytes': covariate_matrix(
+                        df_est, lcm.covariates, dtype).nbytes,
+                    'covariate_bytes_float64': covariate_matrix(
+                        df_est, lcm.covariates).nbytes,
+                    'time': this_time, 'time_float64': time_64})
+
+df_results = pd.DataFrame(results)
+print(df_results.groupby(['data', 'dtype'])[
+    ['frac_matches_changed', 'frac_samples_changed', 'max_dist_diff',
+     'covariate_bytes', 'covariate_bytes_float64', 'time',
+     'time_float64']].mean().to_string())
+if save_folder is not None:
+    df_results.to_csv(f'{save_folder}/precision_matches.csv', index=False)
@@ -7,7 +7,7 @@ import sklearn.linear_model as linear
 from sklearn.model_selection import StratifiedKFold
 from sklearn.neighbors import NearestNeighbors
 
-from utils import prune_covariates, linear_cate, get_model_weights
+from utils import prune_covariates, linear_cates, get_model_weights
 
 
 class Prognostic:
@@ -113,8 +113,7 @@ class Prognostic:
             imp_covs = prune_covariates(self.cov, M)
             these_mgs = df_est[T_est == 0][imp_covs + [self.Y]].to_numpy()[c_mg]
             these_samples = df_est[imp_covs].to_numpy()
-            yc = [linear_cate(these_mgs[i], these_samples[i].reshape(1, -1))
-                  for i in range(these_samples.shape[0])]
+            yc = linear_cates(these_mgs, these_samples)
             if self.double:
                 M = get_model_weights(self.ht, model_weight_attr, False, False,
                                       1)
@@ -122,8 +121,7 @@ class Prognostic:
                 these_samples = df_est[imp_covs].to_numpy()
             these_mgs = df_est[T_est == 1][imp_covs + [self.Y]].to_numpy()[
                 t_mg]
-            yt = [linear_cate(these_mgs[i], these_samples[i].reshape(1, -1))
-                  for i in range(these_samples.shape[0])]
+            yt = linear_cates(these_mgs, these_samples)
         if diameter_prune:
             c_diam = c_dist[:, -1]
             yc = np.where(
@@ -2,6 +2,7 @@
 
 import numpy as np
 import scipy.optimize as opt
+import scipy.sparse as sparse
 import pandas as pd
 import sklearn.linear_model as lm
 import sklearn.ensemble as ensemble
@@ -18,11 +19,15 @@ warnings.filterwarnings("ignore")
 
 class malts:
     def __init__(self, outcome, treatment, data, discrete=[], C=1, k=10,
-                 reweight=False):
+                 reweight=False, low_memory=False, block_size=None):
         np.random.seed(0)
         self.C = C  # coefficient to regularozation term
         self.k = k
         self.reweight = reweight
+        # low_memory computes the weighted distances for block_size rows at a
+        # time instead of storing (n, p, n) difference tensors
+        self.low_memory = low_memory
+        self.block_size = block_size
         self.n, self.p = data.shape
         self.p = self.p - 2  # shape of the data
         self.outcome = outcome
@@ -41,6 +46,8 @@ class malts:
         self.Xd_C = self.df_C[self.discrete].to_numpy()
         self.Y_T = self.df_T[self.outcome].to_numpy()
         self.Y_C = self.df_C[self.outcome].to_numpy()
+        if self.low_memory:
+            return
         self.del2_Y_T = ((np.ones(
             (len(self.Y_T), len(self.Y_T))) * self.Y_T).T - (np.ones(
             (len(self.Y_T), len(self.Y_T))) * self.Y_T)) ** 2
@@ -62,14 +69,21 @@ class malts:
                              self.Xd_C.shape[0])) * self.Xd_C.T
         self.Dd_C = (self.Dd_C != self.Dd_C.T)
 
-    def threshold(self, x):
+    def knn_weights(self, D, start=0):
+        # sparse 0/1 weights of the distances in D below the (k+1)-th
+        # smallest of their row, each row divided by its number of neighbors
+        # other than itself. Row i of D is unit start + i.
         k = self.k
-        for i in range(x.shape[0]):
-            row = x[i, :]
-            row1 = np.where(row < row[np.argpartition(row, k + 1)[k + 1]], 1,
-                            0)
-            x[i, :] = row1
-        return x
+        rows = np.arange(D.shape[0]).reshape(-1, 1)
+        idx = np.argpartition(D, k + 1, axis=1)[:, :k + 2]
+        D_idx = D[rows, idx]
+        keep = D_idx < D_idx[:, k + 1].reshape(-1, 1)
+        n_neighbors = np.sum(keep, axis=1) - np.any(
+            keep & (idx == rows + start), axis=1)
+        values = np.broadcast_to(1 / n_neighbors.reshape(-1, 1), idx.shape)
+        return sparse.csr_matrix(
+            (values[keep], (np.broadcast_to(rows, idx.shape)[keep],
+                            idx[keep])), shape=D.shape)
 
     def distance(self, Mc, Md, xc1, xd1, xc2, xd2):
         dc = np.dot((Mc ** 2) * (xc1 - xc2), (xc1 - xc2))
@@ -80,31 +94,47 @@ class malts:
         w12 = np.exp(-1 * gamma * self.distance(Mc, Md, xc1, xd1, xc2, xd2))
         return w12 * ((y1 - y2) ** 2)
 
+    def calcW_blocks(self, Xc, Xd, Mc, Md):
+        # sparse kNN weights computed from block_size rows of distances at a
+        # time, using O(n * block_size * p) memory
+        n = Xc.shape[0]
+        block_size = self.block_size
+        if block_size is None:
+            block_size = max(1, 2 ** 22 // max(1, n * self.p))
+        W = []
+        for start in range(0, n, block_size):
+            stop = min(start + block_size, n)
+            Dc = np.sum(((Xc[None, :, :] - Xc[start:stop, None, :]) *
+                         Mc) ** 2, axis=2)
+            Dd = np.sum(((Xd[None, :, :] != Xd[start:stop, None, :]) *
+                         Md) ** 2, axis=2)
+            W.append(self.knn_weights(Dc + Dd, start))
+        return sparse.vstack(W, format='csr')
+
     def calcW_T(self, Mc, Md):
+        if self.low_memory:
+            return self.calcW_blocks(self.Xc_T, self.Xd_T, Mc, Md)
         # this step is slow
         Dc = np.sum((self.Dc_T * (Mc.reshape(-1, 1))) ** 2, axis=1)
         Dd = np.sum((self.Dd_T * (Md.reshape(-1, 1))) ** 2, axis=1)
-        W = self.threshold((Dc + Dd))
-        W = W / (np.sum(W, axis=1) - np.diag(W)).reshape(-1, 1)
-        return W
+        return self.knn_weights(Dc + Dd)
 
     def calcW_C(self, Mc, Md):
+        if self.low_memory:
+            return self.calcW_blocks(self.Xc_C, self.Xd_C, Mc, Md)
         # this step is slow
         Dc = np.sum((self.Dc_C * (Mc.reshape(-1, 1))) ** 2, axis=1)
         Dd = np.sum((self.Dd_C * (Md.reshape(-1, 1))) ** 2, axis=1)
-        W = self.threshold((Dc + Dd))
-        W = W / (np.sum(W, axis=1) - np.diag(W)).reshape(-1, 1)
-        return W
+        return self.knn_weights(Dc + Dd)
 
     def Delta_(self, Mc, Md):
         self.W_T = self.calcW_T(Mc, Md)
         self.W_C = self.calcW_C(Mc, Md)
+        # sparse matrix-vector products with the kNN weights
         self.delta_T = np.sum((self.Y_T - (
-                    np.matmul(self.W_T, self.Y_T) - np.diag(
-                self.W_T) * self.Y_T)) ** 2)
+                    self.W_T @ self.Y_T - self.W_T.diagonal() * self.Y_T)) ** 2)
         self.delta_C = np.sum((self.Y_C - (
-                    np.matmul(self.W_C, self.Y_C) - np.diag(
-                self.W_C) * self.Y_C)) ** 2)
+                    self.W_C @ self.Y_C - self.W_C.diagonal() * self.Y_C)) ** 2)
         if self.reweight == False:
             return self.delta_T + self.delta_C
         elif self.reweight == True:
@@ -122,10 +152,143 @@ class malts:
         cons2 = 1e+25 * np.sum((np.concatenate((Mc, Md)) < 0))
         return delta + reg + cons1 + cons2
 
-    def fit(self, method='COBYLA'):
+    def smooth_delta(self, Xc, Xd, Y, Mc, Md, anchors=None, reference=None):
+        # soft-kNN version of the delta of one treatment group: every anchor
+        # unit is predicted by a softmax(-distance) weighted mean of the other
+        # (sorted) reference units, by default all units of the group.
+        # Returns the delta and its gradient with respect to (Mc, Md),
+        # computed block_size anchors at a time
+        if anchors is None:
+            anchors = np.arange(len(Y))
+        if reference is None:
+            reference = np.arange(len(Y))
+        # position of each anchor in the reference units, -1 if not in them
+        self_idx = np.minimum(np.searchsorted(reference, anchors),
+                              len(reference) - 1)
+        self_idx[reference[self_idx] != anchors] = -1
+        n_ref = len(reference)
+        block_size = self.block_size
+        if block_size is None:
+            block_size = max(1, 2 ** 22 // max(1, n_ref * max(1, Xd.shape[1])))
+        shift = np.mean(Xc[reference], axis=0)
+        Xc_r = Xc[reference] - shift
+        Xd_r = Xd[reference]
+        Y_r = Y[reference]
+        Zc_r = Xc_r * Mc
+        sq_r = np.sum(Zc_r ** 2, axis=1)
+        delta = 0
+        grad_c = np.zeros(Xc.shape[1])
+        grad_d = np.zeros(Xd.shape[1])
+        for start in range(0, len(anchors), block_size):
+            stop = min(start + block_size, len(anchors))
+            Xc_a = Xc[anchors[start:stop]] - shift
+            Zc_a = Xc_a * Mc
+            Dc = np.maximum(np.sum(Zc_a ** 2, axis=1).reshape(-1, 1) + sq_r -
+                            2 * Zc_a @ Zc_r.T, 0)
+            Ad = Xd_r[None, :, :] != Xd[anchors[start:stop], None, :]
+            D = Dc + np.sum(Ad * Md ** 2, axis=2)
+            rows = np.flatnonzero(self_idx[start:stop] >= 0)
+            D[rows, self_idx[start:stop][rows]] = np.inf
+            S = np.exp(-(D - np.min(D, axis=1).reshape(-1, 1)))
+            S = S / np.sum(S, axis=1).reshape(-1, 1)
+            Y_hat = S @ Y_r
+            res = Y_hat - Y[anchors[start:stop]]
+            delta += np.sum(res ** 2)
+            # d delta / d D_ij
+            G = -2 * res.reshape(-1, 1) * S * (Y_r - Y_hat.reshape(-1, 1))
+            grad_c += np.sum(G, axis=1) @ Xc_a ** 2 + \
+                np.sum(G, axis=0) @ Xc_r ** 2 - \
+                2 * np.sum(Xc_a * (G @ Xc_r), axis=0)
+            grad_d += np.einsum('ij,ijb->b', G, Ad)
+        return delta, 2 * Mc * grad_c, 2 * Md * grad_d
+
+    def smooth_objective(self, M):
+        # smooth surrogate of objective with its gradient, for L-BFGS-B
+        Mc = M[:len(self.continuous)]
+        Md = M[len(self.continuous):]
+        delta_T, grad_cT, grad_dT = self.smooth_delta(self.Xc_T, self.Xd_T,
+                                                      self.Y_T, Mc, Md)
+        delta_C, grad_cC, grad_dC = self.smooth_delta(self.Xc_C, self.Xd_C,
+                                                      self.Y_C, Mc, Md)
+        w_T, w_C = 1, 1
+        if self.reweight == True:
+            w_T = (len(self.Y_T) + len(self.Y_C)) / len(self.Y_T)
+            w_C = (len(self.Y_T) + len(self.Y_C)) / len(self.Y_C)
+        delta = w_T * delta_T + w_C * delta_C
+        grad = np.concatenate((w_T * grad_cT + w_C * grad_cC,
+                               w_T * grad_dT + w_C * grad_dC))
+        return delta + self.C * np.sum(M ** 2), grad + 2 * self.C * M
+
+    def fit_minibatch(self, batch_size=256, epochs=10, learning_rate=0.05,
+                      n_reference=512, seed=0):
+        # Adam on the smooth objective estimated from batch_size anchor units
+        # per step, split between the treatment groups and predicted from
+        # n_reference random units of their group, so an epoch is O(n). With
+        # n_reference=None they are predicted from all units, O(n^2)
+        rng = np.random.default_rng(seed)
+        groups = [(self.Xc_T, self.Xd_T, self.Y_T),
+                  (self.Xc_C, self.Xd_C, self.Y_C)]
+        w = [1, 1]
+        if self.reweight == True:
+            w = [(len(self.Y_T) + len(self.Y_C)) / len(self.Y_T),
+                 (len(self.Y_T) + len(self.Y_C)) / len(self.Y_C)]
+        n_steps = max(1, int(np.ceil(self.n / batch_size)))
+        beta1, beta2, eps = 0.9, 0.999, 1e-8
+        M = np.ones((self.p,))
+        m1 = np.zeros(self.p)
+        m2 = np.zeros(self.p)
+        t = 0
+        for _ in range(epochs):
+            batches = [np.array_split(rng.permutation(len(Y)), n_steps)
+                       for _, _, Y in groups]
+            values = []
+            for step in range(n_steps):
+                Mc = M[:len(self.continuous)]
+                Md = M[len(self.continuous):]
+                value = self.C * np.sum(M ** 2)
+                grad = 2 * self.C * M
+                for (Xc, Xd, Y), w_g, anchors in zip(groups, w, batches):
+                    anchors = anchors[step]
+                    if len(anchors) == 0:
+                        continue
+                    reference = None
+                    if n_reference is not None and n_reference < len(Y):
+                        reference = np.sort(rng.choice(len(Y), n_reference,
+                                                       replace=False))
+                    delta, grad_c, grad_d = self.smooth_delta(
+                        Xc, Xd, Y, Mc, Md, anchors, reference)
+                    # unbiased estimate of the delta of the whole group
+                    scale = w_g * len(Y) / len(anchors)
+                    value += scale * delta
+                    grad += scale * np.concatenate((grad_c, grad_d))
+                values.append(value)
+                t += 1
+                m1 = beta1 * m1 + (1 - beta1) * grad
+                m2 = beta2 * m2 + (1 - beta2) * grad ** 2
+                M = M - learning_rate * (m1 / (1 - beta1 ** t)) / (
+                    np.sqrt(m2 / (1 - beta2 ** t)) + eps)
+                M = np.maximum(M, 0)
+        return opt.OptimizeResult(x=M, fun=np.mean(values), nit=t,
+                                  success=True,
+                                  message='Ran %d epochs of %d steps' % (
+                                      epochs, n_steps))
+
+    def fit(self, method='COBYLA', **minibatch_params):
         # np.random.seed(0)
         M_init = np.ones((self.p,))
-        res = opt.minimize(self.objective, x0=M_init, method=method)
+        if method == 'L-BFGS-B':
+            # gradient based fit of the smooth objective, falling back on
+            # COBYLA if the line search fails
+            res = opt.minimize(self.smooth_objective, x0=M_init,
+                               method=method, jac=True,
+                               bounds=[(0, None)] * self.p)
+            if not res.success:
+                res = opt.minimize(self.objective, x0=M_init,
+                                   method='COBYLA')
+        elif method == 'minibatch':
+            res = self.fit_minibatch(**minibatch_params)
+        else:
+            res = opt.minimize(self.objective, x0=M_init, method=method)
         self.M = res.x
         self.Mc = self.M[:len(self.continuous)]
         self.Md = self.M[len(self.continuous):]
@@ -134,85 +297,112 @@ class malts:
                                   index=['Diag'])
         return res
 
-    def get_matched_groups(self, df_estimation, k=10):
-        # units to be matched
+    def get_matched_groups_arrays(self, df_estimation, k=10):
+        # positions in df_estimation of the k nearest treated and control
+        # units of every unit and their distances, computed block_size rows
+        # at a time
         Xc = df_estimation[self.continuous].to_numpy()
         Xd = df_estimation[self.discrete].to_numpy()
         Y = df_estimation[self.outcome].to_numpy()
         T = df_estimation[self.treatment].to_numpy()
-        # splitted estimation data for matching
-        df_T = df_estimation.loc[df_estimation[self.treatment] == 1]
-        df_C = df_estimation.loc[df_estimation[self.treatment] == 0]
-        # converting to numpy array
-        Xc_T = df_T[self.continuous].to_numpy()
-        Xc_C = df_C[self.continuous].to_numpy()
-        Xd_T = df_T[self.discrete].to_numpy()
-        Xd_C = df_C[self.discrete].to_numpy()
-        Y_T = df_T[self.outcome].to_numpy()
-        Y_C = df_C[self.outcome].to_numpy()
-        D_T = np.zeros((Y.shape[0], Y_T.shape[0]))
-        D_C = np.zeros((Y.shape[0], Y_C.shape[0]))
-        # distance_treated
-        Dc_T = (np.ones((Xc_T.shape[0], Xc.shape[1], Xc.shape[0])) * Xc.T - (
-                    np.ones(
-                        (Xc.shape[0], Xc.shape[1], Xc_T.shape[0])) * Xc_T.T).T)
-        Dc_T = np.sum((Dc_T * (self.Mc.reshape(-1, 1))) ** 2, axis=1)
-        Dd_T = (np.ones((Xd_T.shape[0], Xd.shape[1], Xd.shape[0])) * Xd.T != (
-                    np.ones(
-                        (Xd.shape[0], Xd.shape[1], Xd_T.shape[0])) * Xd_T.T).T)
-        Dd_T = np.sum((Dd_T * (self.Md.reshape(-1, 1))) ** 2, axis=1)
-        D_T = (Dc_T + Dd_T).T
-        # distance_control
-        Dc_C = (np.ones((Xc_C.shape[0], Xc.shape[1], Xc.shape[0])) * Xc.T - (
-                    np.ones(
-                        (Xc.shape[0], Xc.shape[1], Xc_C.shape[0])) * Xc_C.T).T)
-        Dc_C = np.sum((Dc_C * (self.Mc.reshape(-1, 1))) ** 2, axis=1)
-        Dd_C = (np.ones((Xd_C.shape[0], Xd.shape[1], Xd.shape[0])) * Xd.T != (
-                    np.ones(
-                        (Xd.shape[0], Xd.shape[1], Xd_C.shape[0])) * Xd_C.T).T)
-        Dd_C = np.sum((Dd_C * (self.Md.reshape(-1, 1))) ** 2, axis=1)
-        D_C = (Dc_C + Dd_C).T
-        MG = {}
-        index = df_estimation.index
-        for i in range(Y.shape[0]):
-            # finding k closest control units to unit i
-            idx = np.argpartition(D_C[i, :], k)
-            matched_df_C = pd.DataFrame(np.hstack((Xc_C[idx[:k], :],
-                                                   Xd_C[idx[:k], :].reshape((k,
-                                                                             len(self.discrete))),
-                                                   Y_C[idx[:k]].reshape(-1, 1),
-                                                   D_C[i, idx[:k]].reshape(-1,
-                                                                           1),
-                                                   np.zeros((k, 1)))),
-                                        index=df_C.index[idx[:k]],
-                                        columns=self.continuous + self.discrete + [
-                                            self.outcome, 'distance',
-                                            self.treatment])
-            # finding k closest treated units to unit i
-            idx = np.argpartition(D_T[i, :], k)
-            matched_df_T = pd.DataFrame(np.hstack((Xc_T[idx[:k], :],
-                                                   Xd_T[idx[:k], :].reshape((k,
-                                                                             len(self.discrete))),
-                                                   Y_T[idx[:k]].reshape(-1, 1),
-                                                   D_T[i, idx[:k]].reshape(-1,
-                                                                           1),
-                                                   np.ones((k, 1)))),
-                                        index=df_T.index[idx[:k]],
-                                        columns=self.continuous + self.discrete + [
-                                            self.outcome, 'distance',
-                                            self.treatment])
-            matched_df = pd.DataFrame(
-                np.hstack((Xc[i], Xd[i], Y[i], 0, T[i])).reshape(1, -1),
-                index=['query'],
-                columns=self.continuous + self.discrete + [self.outcome,
-                                                           'distance',
-                                                           self.treatment])
-            matched_df = matched_df.append(matched_df_T.append(matched_df_C))
-            MG[index[i]] = matched_df
-            # {'unit':[ Xc[i], Xd[i], Y[i], T[i] ] ,'control':[ matched_Xc_C, matched_Xd_C, matched_Y_C, d_array_C],'treated':[matched_Xc_T, matched_Xd_T, matched_Y_T, d_array_T ]}
-        MG_df = pd.concat(MG)
+        n = Xc.shape[0]
+        block_size = self.block_size
+        if block_size is None:
+            block_size = max(1, 2 ** 22 // max(1, n * self.p))
+        MG = {'index': df_estimation.index, 'Xc': Xc, 'Xd': Xd, 'Y': Y,
+              'T': T}
+        for name, t in [('treated', 1), ('control', 0)]:
+            pos = np.flatnonzero(T == t)
+            idx = np.zeros((n, k), dtype=int)
+            dist = np.zeros((n, k))
+            for start in range(0, n, block_size):
+                stop = min(start + block_size, n)
+                Dc = np.sum(((Xc[start:stop, None, :] - Xc[None, pos, :]) *
+                             self.Mc) ** 2, axis=2)
+                Dd = np.sum(((Xd[start:stop, None, :] != Xd[None, pos, :]) *
+                             self.Md) ** 2, axis=2)
+                D = Dc + Dd
+                block_idx = np.argpartition(D, k, axis=1)[:, :k]
+                idx[start:stop] = pos[block_idx]
+                dist[start:stop] = np.take_along_axis(D, block_idx, axis=1)
+            MG[name] = idx
+            MG['distance_' + name] = dist
+        return MG
+
+    def matched_groups_frame(self, MG):
+        # MultiIndex (unit, matched unit) frame of the query unit followed by
+        # its treated and control matches
+        n, k = MG['treated'].shape
+        index = MG['index']
+        X = np.hstack((MG['Xc'], MG['Xd'], MG['Y'].reshape(-1, 1)))
+        units = np.hstack((np.arange(n).reshape(-1, 1), MG['treated'],
+                           MG['control']))
+        distance = np.hstack((np.zeros((n, 1)), MG['distance_treated'],
+                              MG['distance_control']))
+        treatment = np.hstack((MG['T'].reshape(-1, 1), np.ones((n, k)),
+                               np.zeros((n, k))))
+        values = np.hstack((X[units.ravel()], distance.reshape(-1, 1),
+                            treatment.reshape(-1, 1)))
+        matched = np.asarray(index, dtype=object)[units]
+        matched[:, 0] = 'query'
+        MG_df = pd.DataFrame(values, index=pd.MultiIndex.from_arrays(
+            [np.repeat(index, 2 * k + 1), matched.ravel()]),
+                             columns=self.continuous + self.discrete + [
+                                 self.outcome, 'distance', self.treatment])
         return MG_df
 
+    def get_matched_groups(self, df_estimation, k=10):
+        return self.matched_groups_frame(
+            self.get_matched_groups_arrays(df_estimation, k))
+
+    def CATE_arrays(self, MG, model='linear'):
+        # CATE method with the matched groups of get_matched_groups_arrays,
+        # batched over all units for the mean and linear models
+        n, k = MG['treated'].shape
+        X = np.hstack((MG['Xc'], MG['Xd']))
+        Y = MG['Y']
+        units = np.hstack((np.arange(n).reshape(-1, 1), MG['treated'],
+                           MG['control']))
+        # largest distance between two units of a matched group
+        V = X * np.concatenate((self.Mc, self.Md))
+        block_size = self.block_size
+        if block_size is None:
+            block_size = max(1, 2 ** 22 // max(1, (2 * k + 1) ** 2 * self.p))
+        diameter = np.zeros(n)
+        for start in range(0, n, block_size):
+            V_mg = V[units[start:start + block_size]]
+            diameter[start:start + block_size] = np.max(np.sum(
+                (V_mg[:, :, None, :] - V_mg[:, None, :, :]) ** 2, axis=3),
+                axis=(1, 2))
+        if model == 'mean':
+            cate = np.mean(Y[MG['treated']], axis=1) - np.mean(
+                Y[MG['control']], axis=1)
+        elif model == 'linear':
+            # lm.Ridge() fits, solving the centered normal equations of every
+            # group at once
+            y_hat = []
+            for idx in [MG['treated'], MG['control']]:
+                X_mean = np.mean(X[idx], axis=1, keepdims=True)
+                Y_mean = np.mean(Y[idx], axis=1, keepdims=True)
+                Xm = X[idx] - X_mean
+                A = np.einsum('nki,nkj->nij', Xm, Xm) + np.eye(X.shape[1])
+                b = np.einsum('nki,nk->ni', Xm, Y[idx] - Y_mean)
+                coef = np.linalg.solve(A, b[:, :, None])[:, :, 0]
+                y_hat.append(Y_mean[:, 0] + np.sum((X - X_mean[:, 0]) * coef,
+                                                   axis=1))
+            cate = y_hat[0] - y_hat[1]
+        elif model == 'RF':
+            cate = np.zeros(n)
+            for i in range(n):
+                yt = ensemble.RandomForestRegressor().fit(
+                    X=X[MG['treated'][i]], y=Y[MG['treated'][i]])
+                yc = ensemble.RandomForestRegressor().fit(
+                    X=X[MG['control'][i]], y=Y[MG['control'][i]])
+                cate[i] = yt.predict(X[[i]])[0] - yc.predict(X[[i]])[0]
+        return pd.DataFrame({'CATE': cate, 'outcome': Y,
+                             'treatment': MG['T'], 'diameter': diameter},
+                            index=MG['index'])
+
     def CATE(self, MG, outcome_discrete=False, model='linear'):
         cate = {}
         for k in pd.unique(MG.index.get_level_values(0)):
@@ -331,7 +521,8 @@ class malts_mf:
     def __init__(self, outcome, treatment, data, discrete=[], C=1, k_tr=15,
                  k_est=50, estimator='linear', smooth_cate=True,
                  reweight=False, n_splits=5, n_repeats=1, split_strategy=None,
-                 output_format='brief', random_state=0):
+                 output_format='brief', random_state=0, low_memory=False,
+                 block_size=None, fit_params=None):
         self.n_splits = n_splits
         self.C = C
         self.k_tr = k_tr
@@ -353,28 +544,26 @@ class malts_mf:
         self.MG_list = []
         self.CATE_df = pd.DataFrame()
         N = np.zeros((data.shape[0], data.shape[0]))
-        self.MG_matrix = pd.DataFrame(N, columns=data.index, index=data.index)
 
         i = 0
         for est_idx, train_idx in gen_skf:
             df_train = data.iloc[train_idx]
             df_est = data.iloc[est_idx]
             m = malts(outcome, treatment, data=df_train, discrete=discrete,
-                      C=self.C, k=self.k_tr, reweight=self.reweight)
-            m.fit()
+                      C=self.C, k=self.k_tr, reweight=self.reweight,
+                      low_memory=low_memory, block_size=block_size)
+            m.fit(**({} if fit_params is None else fit_params))
             self.M_opt_list.append(m.M_opt)
-            mg = m.get_matched_groups(df_est, k_est)
+            mg = m.get_matched_groups_arrays(df_est, k_est)
             self.MG_list.append(mg)
             self.CATE_df = pd.concat(
-                [self.CATE_df, m.CATE(mg, model=estimator)], join='outer',
-                axis=1)
-
-        for i in range(n_splits * n_repeats):
-            mg_i = self.MG_list[i]
-            for a in mg_i.index:
-                if a[1] != 'query':
-                    self.MG_matrix.loc[a[0], a[1]] = self.MG_matrix.loc[
-                                                         a[0], a[1]] + 1
+                [self.CATE_df, m.CATE_arrays(mg, model=estimator)],
+                join='outer', axis=1)
+            # count how often every unit is matched to every other unit
+            rows = data.index.get_indexer(mg['index'])
+            cols = rows[np.hstack((mg['treated'], mg['control']))]
+            np.add.at(N, (rows.reshape(-1, 1), cols), 1)
+        self.MG_matrix = pd.DataFrame(N, columns=data.index, index=data.index)
 
         cate_df = self.CATE_df['CATE']
         cate_df['avg.CATE'] = cate_df.mean(axis=1)
@@ -3,13 +3,16 @@
 Created on April 24 2023
 @author: quinn.lanners
 """
+from joblib import Parallel, delayed
 import numpy as np
 import pandas as pd
 from sklearn.base import clone
 from sklearn.model_selection import RepeatedStratifiedKFold
 
 from utils import config_model, calc_var_imp, get_match_groups, get_CATES, \
-    convert_idx
+    build_nn_index, get_mean_CATES_streaming, get_match_groups_arrays, \
+    get_CATES_arrays, get_mean_CATES_streaming_arrays, matching_array, \
+    use_gram_lasso, calc_var_imp_gram
 
 
 class VIM_CF:
@@ -34,6 +37,30 @@ class VIM_CF:
         Number of times to shuffle the data and repeat the splitting process.
     random_state : None or int, default=None
         Random state to run on.
+    n_jobs : None or int, default=None
+        Number of worker processes used to run the splits in parallel in
+        self.fit(), self.create_mgs(), and self.est_cate(). None means 1
+        unless in a joblib.parallel_backend context, which can also be used
+        to pick a different executor. -1 means using all processors. Results
+        are assembled in split order and do not depend on n_jobs. With
+        self.fit(model='lgbm'), the splits are fit one at a time and LightGBM
+        uses n_jobs threads instead.
+    block_on : None or str, default=None
+        Label of a column with the block of each sample (e.g. a site or school
+        id). If not None, the column is not used as a covariate and samples
+        are only matched to samples in the same block, using a separate
+        nearest neighbor index for each block. Every block must have at least
+        k samples of each treatment class in each estimation set.
+    dtype : str, default='float64'
+        Precision of the covariates used for matching. If 'float32', the
+        covariates, weighted covariates, and match distances are kept in
+        float32. This halves the memory of the search itself only with
+        nn_engine='numba', 'early_abandon', or 'brute' with
+        metric='euclidean'; the other engines convert to float64 internally,
+        so there only the covariate matrices are halved. If 'int8', the
+        covariates must be integers between -128 and 127 (e.g. dummies) and
+        are stored as int8 and weighted in float32. The variable importances
+        are always learned in float64.
 
     Attributes
     -------
@@ -42,8 +69,14 @@ class VIM_CF:
     treatment : str
     p : int
         Number of covariates.
-    data : pd.DataFrame
-        Copy of data with columns ordered properly.
+    X : numpy.array
+        Matrix of all covariates in float64.
+    T : numpy.array
+        Vector of treatments.
+    Y : numpy.array
+        Vector of outcomes.
+    blocks : None or numpy.array
+        Vector of blocks if block_on is not None.
     binary_outcome : bool
         Indicates whether the outcome is binary or not.
     split_strategy : list[(list[int],list[int])]
@@ -56,41 +89,115 @@ class VIM_CF:
         Each dict contains the scores of each model fit on the training data.
         Scores are computed on the same training set using the sklearn
         .score() function associated with the model.
-    MGs : list[dict[str,pd.DataFrame]]
-        Each dictionary corresponds to the MGs generated for each split. Run
-        self.MG()
-    MG_distances : list[dict[str,pd.DataFrame]]
-        Each value to the distance of each matched sample from
-        the corresponding MGs dictionary.
+    MGs : list[MatchGroups]
+        Each MatchGroups object holds the MGs and MG distances generated for
+        each split. Run self.create_mgs() to populate and self.get_mgs() to
+        export as dataframes.
+    k_list : None or list[int]
+        If self.create_mgs() was run with a list of k values, the sorted k
+        values to estimate CATEs for.
     cate_df : pd.DataFrame
         CATE estimates for each sample. Run self.est_cate() to populate.
     est_C_list :
     random_state : None or int
+    n_jobs : None or int
+    block_on : None or str
+    dtype : str
     """
     def __init__(self, outcome, treatment, data, n_splits=5, n_repeats=1,
-                 random_state=None):
-        self.covariates = [c for c in data.columns if c not in
-                           [outcome, treatment]]
+                 random_state=None, n_jobs=None, block_on=None,
+                 dtype='float64'):
+        covariates = [c for c in data.columns if c not in
+                      [outcome, treatment, block_on]]
+        self._setup(data[covariates].to_numpy(dtype=np.float64),
+                    data[treatment].to_numpy(), data[outcome].to_numpy(),
+                    None if block_on is None else data[block_on].to_numpy(),
+                    covariates, outcome, treatment, block_on, n_splits,
+                    n_repeats, random_state, n_jobs, dtype)
+
+    @classmethod
+    def from_arrays(cls, X, T, Y, covariates=None, blocks=None, n_splits=5,
+                    n_repeats=1, random_state=None, n_jobs=None,
+                    dtype='float64', outcome='Y', treatment='T'):
+        """Create a VIM_CF from covariate, treatment, and outcome arrays
+        without building a dataframe. Dataframes are only created when the
+        results are exported.
+
+        Parameters
+        ----------
+        X : numpy.array
+            Matrix of covariates of shape (n, p).
+        T : numpy.array
+            Vector of treatments.
+        Y : numpy.array
+            Vector of outcomes.
+        covariates : None or list[str], default=None
+            Covariate names used when exporting results. If None, set to
+            ['X0', 'X1', ...].
+        blocks : None or numpy.array, default=None
+            If not None, block of each sample. See block_on.
+        n_splits, n_repeats, random_state, n_jobs, dtype
+            See VIM_CF.
+        outcome : str, default='Y'
+            Outcome label used when exporting results.
+        treatment : str, default='T'
+            Treatment label used when exporting results.
+
+        Returns
+        -------
+        VIM_CF
+        """
+        X = np.asarray(X, dtype=np.float64)
+        if covariates is None:
+            covariates = [f'X{i}' for i in range(X.shape[1])]
+        lcm = cls.__new__(cls)
+        lcm._setup(X, np.asarray(T), np.asarray(Y),
+                   None if blocks is None else np.asarray(blocks),
+                   list(covariates), outcome, treatment,
+                   None if blocks is None else 'block', n_splits, n_repeats,
+                   random_state, n_jobs, dtype)
+        return lcm
+
+    def _setup(self, X, T, Y, blocks, covariates, outcome, treatment,
+               block_on, n_splits, n_repeats, random_state, n_jobs, dtype):
+        """Store the sample arrays and settings and create the splits."""
+        self.covariates = covariates
         self.outcome = outcome
         self.treatment = treatment
+        self.block_on = block_on
+        self.dtype = dtype
         self.p = len(self.covariates)
-        self.data = data[[*self.covariates,
-                          self.treatment, self.outcome]].reset_index(drop=True)
-        self.binary_outcome = self.data[self.outcome].nunique() == 2
+        self.X = X
+        self.T = T
+        self.Y = Y
+        self.blocks = blocks
+        self.binary_outcome = pd.Series(Y).nunique() == 2
 
         skf = RepeatedStratifiedKFold(n_splits=n_splits, n_repeats=n_repeats,
                                       random_state=random_state)
-        self.split_strategy = list(skf.split(data, data[treatment]))
+        self.split_strategy = list(skf.split(X, T))
         self.M_list = []
         self.model_scores = []
         self.MGs = []
-        self.MG_distances = []
+        self.k_list = None
         self.cate_df = pd.DataFrame()
         self.random_state = random_state
+        self.n_jobs = n_jobs
+
+    def to_frame(self):
+        """Build a dataframe with the covariates, block, treatment, and
+        outcome of each sample from X, blocks, T, and Y. Changes to it are
+        not seen by this VIM_CF."""
+        data = pd.DataFrame(self.X, columns=self.covariates)
+        if self.block_on is not None:
+            data[self.block_on] = self.blocks
+        data[self.treatment] = self.T
+        data[self.outcome] = self.Y
+        return data
 
     def fit(self, model='linear', params=None, model_weight_attr=None,
             separate_treatments=True, equal_weights=False, metalearner=False,
-            save_scores=True):
+            save_scores=True, screen=None):
         """
         Calculate variable importances to use for the distance metric for each
         split. Overwrites and populates self.M_list and self.model_scores.
@@ -99,9 +206,16 @@ class VIM_CF:
         ----------
         model : str or machine learning class, default='linear'
             Model to use for calculating feature importances. If
-            model='linear', L1-regularized regression (i.e. LASSO). If
+            model='linear', L1-regularized regression (i.e. LASSO), or with a
+            binary outcome L1-regularized logistic regression fit along a
+            regularization path (see utils.L1LogisticPath). The latter
+            replaces LogisticRegressionCV unless params has keys outside
+            utils.L1_PATH_PARAMS (e.g. penalty or solver), and its weights
+            can differ slightly from the saga ones. If
             model='tree', uses shallow decision tree. If model='ensemble',
-            uses gradient boosting regressor/classifier. Otherwise, if a model
+            uses gradient boosting regressor/classifier. If model='lgbm',
+            uses a multithreaded LightGBM regressor/classifier with gain
+            importances (requires lightgbm). Otherwise, if a model
             class is passed, it uses that model. Note that is a model class is
             passed, you must specify an accompanying 'model_weight_attr' that
             is used to pull the variable importance values from the trained
@@ -112,10 +226,10 @@ class VIM_CF:
             method. Otherwise, uses the default params of the specified model.
         model_weight_attr : None or str, default=None
             Indicates the name of the model attribute that stores the variable
-            importance values. If None but model='linear', model='tree', or
-            model='ensemble' then uses the attribute laid out in the
-            create_model() method. Otherwise, the user must provide the correct
-            attribute name.
+            importance values. If None but model='linear', model='tree',
+            model='ensemble', or model='lgbm' then uses the attribute laid
+            out in the create_model() method. Otherwise, the user must provide
+            the correct attribute name.
         separate_treatments : bool, default=False
             Whether the fit separate models to each treatment. If False, will
             fit one model to all samples and use the treatment indicator as a
@@ -128,6 +242,27 @@ class VIM_CF:
             Whether to run metalearner VIM.
         save_scores : bool, default=True
             Whether to save the .score() value for each fit model.
+        screen : None or int, default=None
+            If not None, sure independence screening: each model is only fit
+            to the screen covariates with the largest absolute marginal
+            correlation with the outcome among the samples it is fit to (each
+            treatment class if separate_treatments or metalearner, else all
+            samples). The other covariates get zero weight. Makes fitting the
+            model scale with screen instead of the number of covariates.
+
+        Notes
+        -----
+        If model='linear' with a continuous outcome, the default
+        model_weight_attr, params that are a subset of
+        utils.GRAM_LASSO_PARAMS, and at least 8 samples per covariate, the
+        LASSO of every split is fit by one utils.GramLassoCV per treatment
+        class, which reuses X^T X and X^T y across the splits and their cross
+        validation folds. Each split gets the alpha grid LassoCV would
+        compute from its training samples, so the weights match fitting a
+        LassoCV to each split up to the coordinate descent tolerance, which
+        can still pick a different alpha where the cross validation error is
+        flat. Pass model=sklearn.linear_model.LassoCV() and
+        model_weight_attr='coef_' to fit a LassoCV to each split.
 
         Raises
         ------
@@ -136,55 +271,116 @@ class VIM_CF:
         """
         self.M_list = []
         self.model_scores = []
-        m, weight_attr = config_model(model=model, params=params,
-                                      weight_attr=model_weight_attr,
-                                      binary_outcome=self.binary_outcome,
-                                      random_state=self.random_state)
-        for _, train_idx in self.split_strategy:
-            df_train = self.data.loc[train_idx]
-            final_m, scores = calc_var_imp(
-                df_train[self.covariates].to_numpy(),
-                df_train[self.treatment].to_numpy(),
-                df_train[self.outcome].to_numpy(), m, weight_attr,
+        X, T, Y = self.X, self.T, self.Y
+        if use_gram_lasso(model, params, model_weight_attr,
+                          self.binary_outcome, screen, X.shape):
+            results = calc_var_imp_gram(
+                X, T, Y, self.split_strategy, params=params,
                 separate_treatments=separate_treatments,
                 equal_weights=equal_weights, metalearner=metalearner,
-                calc_scores=save_scores)
+                calc_scores=save_scores, n_jobs=self.n_jobs)
+        else:
+            # LightGBM uses n_jobs threads for each fit, so fit the splits
+            # one at a time instead of in parallel
+            lgbm = isinstance(model, str) and model == 'lgbm'
+            m, weight_attr = config_model(model=model, params=params,
+                                          weight_attr=model_weight_attr,
+                                          binary_outcome=self.binary_outcome,
+                                          random_state=self.random_state,
+                                          n_jobs=self.n_jobs if lgbm else None)
+            results = Parallel(n_jobs=1 if lgbm else self.n_jobs)(
+                delayed(calc_var_imp)(
+                    X[train_idx], T[train_idx], Y[train_idx], clone(m),
+                    weight_attr, separate_treatments=separate_treatments,
+                    equal_weights=equal_weights, metalearner=metalearner,
+                    calc_scores=save_scores, screen=screen)
+                for _, train_idx in self.split_strategy)
+        for final_m, scores in results:
             self.M_list.append(np.copy(final_m))
             if save_scores:
                 self.model_scores.append(scores)
-            m = clone(m)
 
-    def create_mgs(self, k=10):
+    def create_mgs(self, k=10, nn_engine='auto', nn_params=None,
+                   diameters_only=False, dedup=False, metric='cityblock'):
         """Calculate match groups for each split. Overwrites and populates
-        self.MGs and self.MG_distances.
+        self.MGs.
 
         Parameters
         ----------
-        k : int, default=10
+        k : int or list[int], default=10
             Matched group size for each treatment. I.e. if there are two
             treatments, each sample is matched to 10 samples for
-            each treatment for a total of 20 matched units.
+            each treatment for a total of 20 matched units. If a list, one
+            search is run with the largest k and self.est_cate() estimates
+            CATEs for every k in the list from the first k matches.
+        nn_engine : str, default='auto'
+            Nearest neighbor engine to use. If 'auto', uses an exact sorted
+            array (one covariate) or KD tree (two or three covariates) search
+            when at most three covariates have nonzero weight and a sklearn
+            NearestNeighbors tree otherwise. If 'lowdim', always uses the
+            former. If 'sklearn', uses a sklearn NearestNeighbors tree. If
+            'brute', uses an exact chunked brute force search. If 'lsh', uses
+            an approximate Cauchy random projection forest. If 'numba', uses
+            an exact numba compiled search. If 'early_abandon', uses an exact
+            numba compiled search that visits covariates by decreasing weight
+            and abandons candidates that cannot be among the k nearest.
+        nn_params : None or dict, default=None
+            Additional parameters for the nearest neighbor engine. E.g.
+            {'memory_budget': 2**25} for nn_engine='brute' or
+            {'n_trees': 16} for nn_engine='lsh'.
+        diameters_only : bool, default=False
+            Whether to only store the diameter of each match group instead of
+            all the match distances. Saves memory when the distances are only
+            needed for diameter pruning. Cannot be used with a list of k.
+        dedup : bool, default=False
+            Whether to only search the unique weighted covariate vectors and
+            broadcast the matches back to their duplicates. Speeds up matching
+            when many samples share the same values of the covariates with
+            nonzero weight, e.g. dummy encoded categorical covariates.
+        metric : str, default='cityblock'
+            Distance between the weighted covariates. If 'cityblock', the sum
+            of absolute differences. If 'euclidean', the euclidean distance,
+            which nn_engine='brute' computes with BLAS matrix products. The
+            sklearn tree of nn_engine='auto' switches to a similar BLAS
+            search with more than 15 covariates, so 'brute' is only needed
+            for its bounded memory. Not supported by nn_engine='numba' or
+            'early_abandon'.
+
+        Raises
+        ------
+        ValueError
+            diameters_only with a list of k.
         """
-        self.MGs = []
-        self.MG_distances = []
-
-        i = 0
-        for est_idx, _ in self.split_strategy:
-            df_estimation = self.data.loc[est_idx]
-            mgs, mg_dists = get_match_groups(df_estimation, self.covariates,
-                                             self.treatment, M=self.M_list[i],
-                                             k=k,
-                                             return_original_idx=False,
-                                             check_est_df=False)
-            self.MGs.append(mgs)
-            self.MG_distances.append(mg_dists)
-            i += 1
+        if isinstance(k, (list, tuple, np.ndarray)) and diameters_only:
+            raise ValueError('diameters_only cannot be used with a list of '
+                             'k, since the smaller match groups need all the '
+                             'match distances.')
+        if isinstance(k, (list, tuple, np.ndarray)):
+            self.k_list = sorted(k)
+            k = self.k_list[-1]
+        else:
+            self.k_list = None
+        self.MGs = Parallel(n_jobs=self.n_jobs)(
+            delayed(get_match_groups_arrays)(
+                matching_array(self.X[est_idx], self.dtype), self.T[est_idx],
+                M=self.M_list[i], k=k, index=est_idx, nn_engine=nn_engine,
+                nn_params=nn_params, diameters_only=diameters_only,
+                dedup=dedup, blocks=self._split_blocks(est_idx),
+                metric=metric)
+            for i, (est_idx, _) in enumerate(self.split_strategy))
 
     def est_cate(self, cate_methods=None, diameter_prune=3,
-                 cov_imp_prune=0.01):
+                 cov_imp_prune=0.01, k=10, nn_engine='auto', nn_params=None,
+                 chunk_size=4096, dedup=False, metric='cityblock'):
         """Calculates CATE estimates for each split. Populates self.cate_df
         with each split estimates and the avg and std of each sample's CATE
-        estimates across all the n_splits-1 estimates.
+        estimates across all the n_splits-1 estimates. If self.create_mgs()
+        was run with a list of k values, the columns of each k are suffixed
+        with _k{k}.
+
+        If self.create_mgs() has not been run, the 'mean' CATEs are estimated
+        by matching and averaging the samples of each split in chunks without
+        storing the match groups.
 
         Parameters
         ----------
@@ -198,44 +394,78 @@ class VIM_CF:
         cov_imp_prune : float, default=0.01
             Minimum relative feature importance to not prune covariate. Only
             used if method == 'linear_pruned'.
+        k : int, default=10
+            Matched group size for each treatment. Only used if
+            self.create_mgs() has not been run.
+        nn_engine : str, default='auto'
+            Nearest neighbor engine to use. Only used if self.create_mgs() has
+            not been run.
+        nn_params : None or dict, default=None
+            Additional parameters for the nearest neighbor engine. Only used
+            if self.create_mgs() has not been run.
+        chunk_size : int, default=4096
+            Number of samples matched at once. Only used if self.create_mgs()
+            has not been run.
+        dedup : bool, default=False
+            Whether to only search the unique weighted covariate vectors. Only
+            used if self.create_mgs() has not been run.
+        metric : str, default='cityblock'
+            Distance between the weighted covariates. Only used if
+            self.create_mgs() has not been run.
         """
         if cate_methods is None:
             cate_methods = ['mean']
-        cates_list = []
-        i = 0
-        for est_idx, _ in self.split_strategy:
-            df_estimation = self.data.loc[est_idx]
-            cates = []
-            for method in cate_methods:
-                cates.append(get_CATES(df_estimation, self.MGs[i],
-                                       self.MG_distances[i], self.outcome,
-                                       self.covariates, self.M_list[i],
-                                       method, diameter_prune, cov_imp_prune,
-                                       check_est_df=False)
-                             )
-            cates = pd.concat(cates, axis=1).sort_index()
-            cates_list.append(cates.copy(deep=True))
-            i += 1
+        if len(self.MGs) == 0:
+            if cate_methods != ['mean']:
+                raise Exception('Run self.create_mgs() before estimating '
+                                'CATEs with methods other than mean.')
+            cates_list = Parallel(n_jobs=self.n_jobs)(
+                delayed(get_mean_CATES_streaming_arrays)(
+                    matching_array(self.X[est_idx], self.dtype),
+                    self.T[est_idx], self.Y[est_idx], self.M_list[i], k=k,
+                    diameter_prune=diameter_prune, chunk_size=chunk_size,
+                    index=est_idx, nn_engine=nn_engine, nn_params=nn_params,
+                    dedup=dedup, blocks=self._split_blocks(est_idx),
+                    metric=metric)
+                for i, (est_idx, _) in enumerate(self.split_strategy))
+        else:
+            cates_list = self._est_cate_mgs(cate_methods, diameter_prune,
+                                            cov_imp_prune)
         self.cate_df = pd.concat(cates_list, axis=1).sort_index()
         for col in [c for c in np.unique(self.cate_df.columns) if 'CATE' in c]:
                 self.cate_df[f'avg.{col}'] = self.cate_df[col].mean(axis=1)
                 self.cate_df[f'std.{col}'] = self.cate_df[col].std(axis=1)
-        self.cate_df[self.treatment] = self.data[self.treatment]
-        self.cate_df[self.outcome] = self.data[self.outcome]
+        self.cate_df[self.treatment] = pd.Series(self.T)
+        self.cate_df[self.outcome] = pd.Series(self.Y)
+
+    def _split_blocks(self, est_idx):
+        """Get the blocks of an estimation set, if any."""
+        return None if self.blocks is None else self.blocks[est_idx]
+
+    def _est_cate_mgs(self, cate_methods, diameter_prune, cov_imp_prune):
+        """Calculate the CATE estimates of each split from self.MGs."""
+        k_list = [None] if self.k_list is None else self.k_list
+        cates = Parallel(n_jobs=self.n_jobs)(
+            delayed(get_CATES_arrays)(
+                self.MGs[i], self.Y[est_idx], self.M_list[i], method,
+                diameter_prune, cov_imp_prune,
+                X=self.X[est_idx] if 'linear' in method else None, k=k)
+            for i, (est_idx, _) in enumerate(self.split_strategy)
+            for method in cate_methods for k in k_list)
+        n_cols = len(cate_methods) * len(k_list)
+        return [pd.concat(cates[i:i + n_cols], axis=1).sort_index()
+                for i in range(0, len(cates), n_cols)]
 
     def get_mgs(self, return_distance=False):
-        """Get all match groups."""
+        """Get all match groups as dataframes labeled by the original index."""
         mg_list = []
-        i = 0
-        for est_idx, train_idx in self.split_strategy:
-            this_mg = {}
-            these_mgs = self.MGs[i]
-            for t, mg in these_mgs.items():
-                this_mg[t] = convert_idx(mg, est_idx)
+        mg_dist_list = []
+        for mgs in self.MGs:
+            this_mg, this_mg_dist = mgs.to_frames(return_original_idx=True)
             mg_list.append(this_mg)
-            i += 1
+            mg_dist_list.append(this_mg_dist)
         if return_distance:
-            return mg_list, self.MG_distances
+            return mg_list, mg_dist_list
         else:
             return mg_list
 
@@ -258,6 +488,25 @@ class VIM:
         Whether the treatment is binary.
     random_state : None or int, default=None
         Random state to run on.
+    block_on : None or str, default=None
+        Label of a column with the block of each sample (e.g. a site or school
+        id). If not None, the column is not used as a covariate and samples
+        are only matched to samples in the same block, using a separate
+        nearest neighbor index for each block. Every block must have at least
+        k samples of each treatment class.
+    n_jobs : None or int, default=None
+        Number of threads used to search the blocks in parallel if block_on
+        is not None and by LightGBM in self.fit(model='lgbm').
+    dtype : str, default='float64'
+        Precision of the covariates used for matching. If 'float32', the
+        covariates, weighted covariates, and match distances are kept in
+        float32. This halves the memory of the search itself only with
+        nn_engine='numba', 'early_abandon', or 'brute' with
+        metric='euclidean'; the other engines convert to float64 internally,
+        so there only the covariate matrices are halved. If 'int8', the
+        covariates must be integers between -128 and 127 (e.g. dummies) and
+        are stored as int8 and weighted in float32. The variable importances
+        are always learned in float64.
 
     Attributes
     -------
@@ -282,29 +531,92 @@ class VIM:
     M : None, list type, or dict
         Covariate weights to use for matching. Is dictionary containing weights
         for each treatment is class run as metalearner.
+    df_reference : None or pandas.DataFrame
+        Reference population new samples are matched to. Run
+        self.build_reference() to populate.
+    nn_index : None or dict
+        Nearest neighbor objects fit to each treatment class of
+        df_reference. Run self.build_reference() to populate.
     random_state : None or int
+    block_on : None or str
+    n_jobs : None or int
+    dtype : str
     """
     def __init__(self, outcome, treatment, data, binary_outcome=False,
-                 random_state=None):
-        self.n, self.p = data.shape
-        self.p -= 2
+                 random_state=None, block_on=None, n_jobs=None,
+                 dtype='float64'):
+        covariates = [c for c in data.columns if c not in
+                      [outcome, treatment, block_on]]
+        self._setup(data[covariates].to_numpy(), data[treatment].to_numpy(),
+                    data[outcome].to_numpy(), covariates, outcome, treatment,
+                    binary_outcome, random_state, block_on, n_jobs, dtype)
+
+    @classmethod
+    def from_arrays(cls, X, T, Y, covariates=None, binary_outcome=False,
+                    random_state=None, block_on=None, n_jobs=None,
+                    dtype='float64', outcome='Y', treatment='T'):
+        """Create a VIM from covariate, treatment, and outcome arrays without
+        building a dataframe.
+
+        Parameters
+        ----------
+        X : numpy.array
+            Matrix of covariates of shape (n, p).
+        T : numpy.array
+            Vector of treatments.
+        Y : numpy.array
+            Vector of outcomes.
+        covariates : None or list[str], default=None
+            Covariate names, i.e. the columns the estimation and reference
+            dataframes must include. If None, set to ['X0', 'X1', ...].
+        binary_outcome, random_state, block_on, n_jobs, dtype
+            See VIM. block_on only names the block column of the estimation
+            and reference dataframes; X must not include it.
+        outcome : str, default='Y'
+            Outcome column label of the estimation and reference dataframes.
+        treatment : str, default='T'
+            Treatment column label of the estimation and reference dataframes.
+
+        Returns
+        -------
+        VIM
+        """
+        X = np.asarray(X)
+        if covariates is None:
+            covariates = [f'X{i}' for i in range(X.shape[1])]
+        lcm = cls.__new__(cls)
+        lcm._setup(X, np.asarray(T), np.asarray(Y), list(covariates), outcome,
+                   treatment, binary_outcome, random_state, block_on, n_jobs,
+                   dtype)
+        return lcm
+
+    def _setup(self, X, T, Y, covariates, outcome, treatment, binary_outcome,
+               random_state, block_on, n_jobs, dtype):
+        """Store the training arrays and settings."""
         self.outcome = outcome
         self.treatment = treatment
-        self.covariates = [c for c in data.columns if c not in
-                           [outcome, treatment]]
-        self.col_order = [*self.covariates, self.treatment, self.outcome]
-        data = data[self.col_order]
+        self.block_on = block_on
+        self.n_jobs = n_jobs
+        self.dtype = dtype
+        self.covariates = covariates
+        self.n = X.shape[0]
+        self.p = len(self.covariates)
+        block_cols = [] if block_on is None else [block_on]
+        self.col_order = [*self.covariates, *block_cols, self.treatment,
+                          self.outcome]
         self.binary_outcome = binary_outcome
-        self.X = data[self.covariates].to_numpy()
-        self.T = data[self.treatment].to_numpy()
-        self.Y = data[self.outcome].to_numpy()
+        self.X = X
+        self.T = T
+        self.Y = Y
         self.treatment_classes = np.unique(self.T)
         self.M = None
+        self.df_reference = None
+        self.nn_index = None
         self.random_state = random_state
 
     def fit(self, model='linear', params=None, model_weight_attr=None,
             separate_treatments=True, equal_weights=False, metalearner=False,
-            return_scores=False):
+            return_scores=False, screen=None):
         """
         Calculates variable importances to use for distance metric and stores
         in self.M.
@@ -313,9 +625,16 @@ class VIM:
         ----------
         model : str or machine learning class, default='linear'
             Model to use for calculating feature importances. If
-            model='linear', L1-regularized regression (i.e. LASSO). If
+            model='linear', L1-regularized regression (i.e. LASSO), or with a
+            binary outcome L1-regularized logistic regression fit along a
+            regularization path (see utils.L1LogisticPath). The latter
+            replaces LogisticRegressionCV unless params has keys outside
+            utils.L1_PATH_PARAMS (e.g. penalty or solver), and its weights
+            can differ slightly from the saga ones. If
             model='tree', uses shallow decision tree. If model='ensemble',
-            uses gradient boosting regressor/classifier. Otherwise, if a model
+            uses gradient boosting regressor/classifier. If model='lgbm',
+            uses a multithreaded LightGBM regressor/classifier with gain
+            importances (requires lightgbm). Otherwise, if a model
             class is passed, it uses that model. Note that is a model class is
             passed, you must specify an accompanying 'model_weight_attr' that
             is used to pull the variable importance values from the trained
@@ -326,10 +645,10 @@ class VIM:
             method. Otherwise, uses the default params of the specified model.
         model_weight_attr : None or str, default=None
             Indicates the name of the model attribute that stores the variable
-            importance values. If None but model='linear', model='tree', or
-            model='ensemble' then uses the attribute laid out in the
-            create_model() method. Otherwise, the user must provide the correct
-            attribute name.
+            importance values. If None but model='linear', model='tree',
+            model='ensemble', or model='lgbm' then uses the attribute laid
+            out in the create_model() method. Otherwise, the user must provide
+            the correct attribute name.
         separate_treatments : bool, default=False
             Whether the fit separate models to each treatment. If False, will
             fit one model to all samples and use the treatment indicator as a
@@ -342,6 +661,13 @@ class VIM:
             Whether to run metalearner VIM.
         return_scores : bool, default=False
             Whether to return the 'score()' of each fitted model.
+        screen : None or int, default=None
+            If not None, sure independence screening: each model is only fit
+            to the screen covariates with the largest absolute marginal
+            correlation with the outcome among the samples it is fit to (each
+            treatment class if separate_treatments or metalearner, else all
+            samples). The other covariates get zero weight. Makes fitting the
+            model scale with screen instead of the number of covariates.
 
         Raises
         ------
@@ -356,65 +682,180 @@ class VIM:
         m, weight_attr = config_model(model=model, params=params,
                                       weight_attr=model_weight_attr,
                                       binary_outcome=self.binary_outcome,
-                                      random_state=self.random_state)
+                                      random_state=self.random_state,
+                                      n_jobs=self.n_jobs)
         final_m, scores = calc_var_imp(
             self.X, self.T, self.Y, m, weight_attr,
             separate_treatments=separate_treatments,
             equal_weights=equal_weights, metalearner=metalearner,
-            calc_scores=return_scores)
+            calc_scores=return_scores, screen=screen)
         self.M = np.copy(final_m)
+        self.df_reference = None
+        self.nn_index = None
         if return_scores:
             return scores
 
-    def create_mgs(self, df_estimation, k=10, return_original_idx=False):
+    def build_reference(self, df_reference, k=10, nn_engine='auto',
+                        nn_params=None, dedup=False, metric='cityblock'):
+        """Fit nearest neighbor indexes to each treatment class of a reference
+        population. Populates self.df_reference and self.nn_index so that new
+        samples can be matched to the reference population by passing
+        use_reference=True to self.create_mgs() and self.est_cate(). Must be
+        rerun after self.fit().
+
+        Parameters
+        ----------
+        df_reference : pandas.DataFrame
+            Reference population. Should include same columns as the training
+            set.
+        k : int, default=10
+            Default matched group size used by nearest neighbor engines that
+            tune their structure to k. Queries may use any k.
+        nn_engine : str, default='auto'
+            Nearest neighbor engine to use. If 'auto', uses an exact sorted
+            array (one covariate) or KD tree (two or three covariates) search
+            when at most three covariates have nonzero weight and a sklearn
+            NearestNeighbors tree otherwise. If 'lowdim', always uses the
+            former. If 'sklearn', uses a sklearn NearestNeighbors tree. If
+            'brute', uses an exact chunked brute force search. If 'lsh', uses
+            an approximate Cauchy random projection forest. If 'numba', uses
+            an exact numba compiled search. If 'early_abandon', uses an exact
+            numba compiled search that visits covariates by decreasing weight
+            and abandons candidates that cannot be among the k nearest.
+        nn_params : None or dict, default=None
+            Additional parameters for the nearest neighbor engine.
+        dedup : bool, default=False
+            Whether to index only the unique weighted covariate vectors of
+            the reference population and broadcast the matches back to their
+            duplicates.
+        metric : str, default='cityblock'
+            Distance between the weighted covariates. If 'cityblock', the sum
+            of absolute differences. If 'euclidean', the euclidean distance,
+            which nn_engine='brute' computes with BLAS matrix products. The
+            sklearn tree of nn_engine='auto' switches to a similar BLAS
+            search with more than 15 covariates, so 'brute' is only needed
+            for its bounded memory. Not supported by nn_engine='numba' or
+            'early_abandon'.
+        """
+        self.df_reference = df_reference[self.col_order]
+        self.nn_index = build_nn_index(self.df_reference, self.covariates,
+                                       self.treatment, M=self.M, k=k,
+                                       nn_engine=nn_engine,
+                                       nn_params=nn_params, dedup=dedup,
+                                       block_on=self.block_on,
+                                       n_jobs=self.n_jobs, metric=metric,
+                                       dtype=self.dtype)
+
+    def create_mgs(self, df_estimation, k=10, nn_engine='auto',
+                   nn_params=None, use_reference=False, diameters_only=False,
+                   dedup=False, metric='cityblock'):
         """Get the match groups for a given estimation set.
 
         Parameters
         ----------
         df_estimation : pandas.DataFrame
             Estimation set. Should include same columns as the training set.
-        k : int, default=10
+        k : int or list[int], default=10
             Matched group size for each treatment. I.e. if there are two
             treatments, each sample is matched to 10 samples for
-            each treatment for a total of 20 matched units.
-        return_original_idx : bool, default=False
-            Whether to return the matched groups using the original index to
-            label the samples. If False, the index is reset before computing
-            matched groups (i.e. the first sample in the dataframe will be
-            sample 0).
+            each treatment for a total of 20 matched units. If a list, the
+            match groups are created for the largest k and smaller match
+            groups can be taken with match_groups.subset(k).
+        nn_engine : str, default='auto'
+            Nearest neighbor engine to use. If 'auto', uses an exact sorted
+            array (one covariate) or KD tree (two or three covariates) search
+            when at most three covariates have nonzero weight and a sklearn
+            NearestNeighbors tree otherwise. If 'lowdim', always uses the
+            former. If 'sklearn', uses a sklearn NearestNeighbors tree. If
+            'brute', uses an exact chunked brute force search. If 'lsh', uses
+            an approximate Cauchy random projection forest. If 'numba', uses
+            an exact numba compiled search. If 'early_abandon', uses an exact
+            numba compiled search that visits covariates by decreasing weight
+            and abandons candidates that cannot be among the k nearest.
+        nn_params : None or dict, default=None
+            Additional parameters for the nearest neighbor engine. E.g.
+            {'memory_budget': 2**25} for nn_engine='brute' or
+            {'n_trees': 16} for nn_engine='lsh'.
+        use_reference : bool, default=False
+            Whether to match the samples to the reference population stored
+            by self.build_reference() instead of to each other. If True, the
+            returned matches refer to self.df_reference and df_estimation does
+            not need a treatment column.
+        diameters_only : bool, default=False
+            Whether to only keep the diameter of each match group instead of
+            all the match distances. Cannot be used with a list of k.
+        dedup : bool, default=False
+            Whether to only search the unique weighted covariate vectors and
+            broadcast the matches back to their duplicates. If use_reference,
+            set by self.build_reference() instead.
+        metric : str, default='cityblock'
+            Distance between the weighted covariates. If 'cityblock', the sum
+            of absolute differences. If 'euclidean', the euclidean distance,
+            which nn_engine='brute' computes with BLAS matrix products. The
+            sklearn tree of nn_engine='auto' switches to a similar BLAS
+            search with more than 15 covariates, so 'brute' is only needed
+            for its bounded memory. Not supported by nn_engine='numba' or
+            'early_abandon'. If use_reference, set by self.build_reference()
+            instead.
 
         Returns
         -------
         match_groups
-            Matched groups for each sample.
-        match_distances
-            The distances between each sample and each of its matched samples.
-            The position of each distance corresponds to the match in the
-            returned match_groups.
+            MatchGroups with the matched groups for each sample and the
+            distances between each sample and each of its matched samples.
+            Use match_groups.to_frames() to export them as dataframes.
+
+        Raises
+        ------
+        ValueError
+            diameters_only with a list of k.
         """
+        if isinstance(k, (list, tuple, np.ndarray)) and diameters_only:
+            raise ValueError('diameters_only cannot be used with a list of '
+                             'k, since the smaller match groups need all the '
+                             'match distances.')
+        if isinstance(k, (list, tuple, np.ndarray)):
+            k = max(k)
+        if use_reference:
+            if self.nn_index is None:
+                raise Exception('No reference population. Run '
+                                'self.build_reference() first.')
+            return get_match_groups(df_estimation, self.covariates,
+                                    self.treatment, M=self.M, k=k,
+                                    df_reference=self.df_reference,
+                                    nn_index=self.nn_index,
+                                    diameters_only=diameters_only,
+                                    block_on=self.block_on,
+                                    dtype=self.dtype)
         return get_match_groups(df_estimation, self.covariates,
                                 self.treatment, M=self.M, k=k,
-                                return_original_idx=return_original_idx)
+                                nn_engine=nn_engine, nn_params=nn_params,
+                                diameters_only=diameters_only, dedup=dedup,
+                                block_on=self.block_on, n_jobs=self.n_jobs,
+                                metric=metric, dtype=self.dtype)
 
     def est_cate(self, df_estimation, match_groups=None, match_distances=None,
-                 k=10, method='mean', diameter_prune=None, cov_imp_prune=0.01):
+                 k=10, method='mean', diameter_prune=None, cov_imp_prune=0.01,
+                 nn_engine='auto', nn_params=None, use_reference=False,
+                 chunk_size=4096, dedup=False, metric='cityblock'):
         """Get CATE estimates for each sample in an estimation set.
 
         Parameters
         ----------
         df_estimation : pandas.DataFrame
             Estimation set. Should include same columns as the training set.
-        match_groups : None or dict[str,pd.DataFrame], default=None
-            Either an object of the same structure as that returned from
-            self.create_mgs() or None. If None, this function runs
-            self.create_mgs() first.
+        match_groups : None, MatchGroups, or dict[str,pd.DataFrame], default=None
+            Either a MatchGroups object returned from self.create_mgs(), the
+            match groups dictionary returned by its to_frames(False), or None.
+            If None, this function runs self.create_mgs() first.
         match_distances : None or dict[str,pd.DataFrame], default=None
-            Either an object of the same structure as that returned from
-            self.create_mgs() or None. If None, this function runs
-            self.create_mgs() first.
-        k : int, default=10
-            If match_groups or match_distances is None, used as the k for
-            self.create_mgs()
+            Match distances dictionary returned by to_frames(False). Only
+            needed if match_groups is a dictionary.
+        k : int or list[int], default=10
+            If match_groups is None, used as the k for self.create_mgs(). If
+            a list, CATEs are estimated for each k from the first k matches of
+            one set of match groups and the columns of each k are suffixed
+            with _k{k}.
         method : str, default='mean'
             Method to use inside match groups to estimate CATEs. Currently
             accepts 'mean', 'linear', and 'linear_pruned'.
@@ -425,15 +866,68 @@ class VIM:
         cov_imp_prune : float, default=0.01
             Minimum relative feature importance to not prune covariate. Only
             used if method == 'linear_pruned'.
+        nn_engine : str, default='auto'
+            If match_groups is None, nearest neighbor engine used by
+            self.create_mgs().
+        nn_params : None or dict, default=None
+            If match_groups is None, additional parameters for the nearest
+            neighbor engine used by self.create_mgs().
+        use_reference : bool, default=False
+            Whether the samples are matched to the reference population stored
+            by self.build_reference(). If True, the outcomes of the matched
+            reference samples are used and df_estimation does not need
+            treatment or outcome columns.
+        chunk_size : int, default=4096
+            If match_groups is None, method='mean', and k is an int, the
+            samples are matched and their matched outcomes averaged in chunks
+            of chunk_size without storing the match groups.
+        dedup : bool, default=False
+            If match_groups is None, whether to only search the unique
+            weighted covariate vectors.
+        metric : str, default='cityblock'
+            If match_groups is None, distance between the weighted covariates
+            used by self.create_mgs().
 
         Returns
         -------
         pd.DataFrame with CATE estimates for each sample in df_estimation.
         """
-        if (match_groups is None) or (match_distances is None):
-            match_groups, match_distances = self.create_mgs(
-                df_estimation=df_estimation, k=k, return_original_idx=False)
-        return get_CATES(df_estimation, match_groups, match_distances,
-                         self.outcome, self.covariates, self.M,
-                         method=method, diameter_prune=diameter_prune,
-                         cov_imp_prune=cov_imp_prune)
+        k_list = k if isinstance(k, (list, tuple, np.ndarray)) else None
+        if (match_groups is None) and (method == 'mean') and (k_list is None):
+            if use_reference:
+                if self.nn_index is None:
+                    raise Exception('No reference population. Run '
+                                    'self.build_reference() first.')
+                return get_mean_CATES_streaming(
+                    df_estimation, self.covariates, self.treatment,
+                    self.outcome, self.M, k=k, diameter_prune=diameter_prune,
+                    chunk_size=chunk_size, df_reference=self.df_reference,
+                    nn_index=self.nn_index, block_on=self.block_on,
+                    dtype=self.dtype)
+            return get_mean_CATES_streaming(
+                df_estimation, self.covariates, self.treatment, self.outcome,
+                self.M, k=k, diameter_prune=diameter_prune,
+                chunk_size=chunk_size, nn_engine=nn_engine,
+                nn_params=nn_params, dedup=dedup, block_on=self.block_on,
+                n_jobs=self.n_jobs, metric=metric, dtype=self.dtype)
+        if match_groups is None:
+            match_groups = self.create_mgs(
+                df_estimation=df_estimation, k=k, nn_engine=nn_engine,
+                nn_params=nn_params, use_reference=use_reference,
+                diameters_only=k_list is None, dedup=dedup, metric=metric)
+        if k_list is None:
+            return get_CATES(df_estimation, match_groups, match_distances,
+                             self.outcome, self.covariates, self.M,
+                             method=method, diameter_prune=diameter_prune,
+                             cov_imp_prune=cov_imp_prune,
+                             df_reference=(self.df_reference if use_reference
+                                           else None))
+        return pd.concat([get_CATES(df_estimation, match_groups,
+                                    match_distances, self.outcome,
+                                    self.covariates, self.M, method=method,
+                                    diameter_prune=diameter_prune,
+                                    cov_imp_prune=cov_imp_prune,
+                                    df_reference=(self.df_reference
+                                                  if use_reference else None),
+                                    k=this_k)
+                          for this_k in sorted(k_list)], axis=1)
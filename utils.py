@@ -1,23 +1,45 @@
 from itertools import combinations
+from joblib import Parallel, delayed
 import numpy as np
 import pandas as pd
-from sklearn.base import clone
+from sklearn.base import BaseEstimator, ClassifierMixin, clone
 import sklearn.ensemble as ensemble
 import sklearn.linear_model as linear
+from sklearn.model_selection import StratifiedKFold
+from scipy.special import expit
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
 from sklearn.neighbors import NearestNeighbors
 import sklearn.tree as tree
 import warnings
 
+try:
+    import lightgbm
+except ImportError:
+    lightgbm = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
 
 def config_model(model='linear', params=None, weight_attr=None,
-                 binary_outcome=False, random_state=None):
+                 binary_outcome=False, random_state=None, n_jobs=None):
     """Configure the appropriate model to use given the passed args.
 
     Parameters
     ----------
     model : str or sklearn model class, default=False
         Indicates what type of model to use. If str must be either
-        'linear', 'tree', or 'ensemble'. Otherwise, can pass any sklearn
+        'linear', 'tree', 'ensemble', or 'lgbm'. If 'linear' and
+        binary_outcome, uses L1LogisticPath unless params has keys outside
+        L1_PATH_PARAMS (e.g. penalty or solver), in which case
+        LogisticRegressionCV. L1LogisticPath fits the same penalized model
+        and C grid as LogisticRegressionCV(penalty='l1'), but the
+        coefficients can differ slightly from the saga ones. If 'lgbm', uses a
+        multithreaded histogram based LightGBM regressor/classifier with
+        gain importances. Otherwise, can pass any sklearn
         model class as long as the corresponding 'weight_attr' is set to
         be the appropriate model attribute to retrieve the feature
         importance weights from.
@@ -26,7 +48,7 @@ def config_model(model='linear', params=None, weight_attr=None,
         with model parameters.
     weight_attr : None or str, default=None
         If None and model == 'linear' then set to coef_
-        If None and model == 'tree' or 'ensemble then set to
+        If None and model == 'tree', 'ensemble', or 'lgbm' then set to
             feature_importances_
         Otherwise, if model is sklearn model class, must be str specifying
         the appropriate model attribute to use to retrieve feature
@@ -35,6 +57,9 @@ def config_model(model='linear', params=None, weight_attr=None,
         Whether the outcome is binary or not.
     random_state : None or int, default=None
         Random state to use.
+    n_jobs : None or int, default=None
+        Number of threads LightGBM uses if model == 'lgbm' or L1LogisticPath
+        uses to fit its folds. If None, their default.
 
     Returns
     -------
@@ -46,11 +71,7 @@ def config_model(model='linear', params=None, weight_attr=None,
     """
     if params is None:
         if model == 'linear':
-            if binary_outcome:
-                params = {'penalty': 'l1', 'solver': 'saga',
-                          'max_iter': 500}
-            else:
-                params = {'max_iter': 5000}
+            params = {} if binary_outcome else {'max_iter': 5000}
         elif model == 'tree':
             params = {'max_depth': 4}
         else:
@@ -59,7 +80,11 @@ def config_model(model='linear', params=None, weight_attr=None,
     if model == 'linear':
         if weight_attr is None:
             weight_attr = 'coef_'
-        if binary_outcome:
+        if binary_outcome and set(params) <= L1_PATH_PARAMS:
+            if n_jobs is not None:
+                params.setdefault('n_jobs', n_jobs)
+            m = L1LogisticPath(**params)
+        elif binary_outcome:
             m = linear.LogisticRegressionCV(**params)
         else:
             m = linear.LassoCV(**params)
@@ -77,6 +102,19 @@ def config_model(model='linear', params=None, weight_attr=None,
             m = ensemble.GradientBoostingClassifier(**params)
         else:
             m = ensemble.GradientBoostingRegressor(**params)
+    elif model == 'lgbm':
+        if lightgbm is None:
+            raise Exception("model='lgbm' requires lightgbm to be installed")
+        if weight_attr is None:
+            weight_attr = 'feature_importances_'
+        params.setdefault('importance_type', 'gain')
+        params.setdefault('verbose', -1)
+        if n_jobs is not None:
+            params['n_jobs'] = n_jobs
+        if binary_outcome:
+            m = lightgbm.LGBMClassifier(**params)
+        else:
+            m = lightgbm.LGBMRegressor(**params)
     else:
         m = model.set_params(**params)
     return m, weight_attr
@@ -84,7 +122,7 @@ def config_model(model='linear', params=None, weight_attr=None,
 
 def calc_var_imp(x_train, t_train, y_train, m, weight_attr,
                  separate_treatments=True, equal_weights=False,
-                 metalearner=False, calc_scores=True):
+                 metalearner=False, calc_scores=True, screen=None):
     """Calculate the variable importance measures using the passed data and
     model.
 
@@ -113,6 +151,11 @@ def calc_var_imp(x_train, t_train, y_train, m, weight_attr,
         Whether to train the metalearner variety of VIM.
     calc_scores : bool, default=True
         Whether to calculate the .score() of each fit model.
+    screen : None or int, default=None
+        If not None, each model is only fit to the screen covariates with the
+        largest absolute marginal correlation with the outcome among the
+        samples it is fit to. The other covariates get zero weight. See
+        screen_covariates().
 
     Returns
     -------
@@ -124,21 +167,27 @@ def calc_var_imp(x_train, t_train, y_train, m, weight_attr,
     """
     scores = {}
     treatment_classes = np.unique(t_train)
+    p = x_train.shape[1]
     if metalearner or separate_treatments:
         all_ms = []
         for t in treatment_classes:
+            x_t = x_train[t_train == t, :]
+            y_t = y_train[t_train == t]
+            cols = screen_covariates(x_t, y_t, screen)
+            if cols is not None:
+                x_t = x_t[:, cols]
             try:
-                m.fit(x_train[t_train == t, :], y_train[t_train == t])
+                m.fit(x_t, y_t)
                 if calc_scores:
-                    scores[t] = m.score(x_train[t_train == t, :],
-                                        y_train[t_train == t])
+                    scores[t] = m.score(x_t, y_t)
             except ValueError as err:
-                setattr(m, weight_attr, np.zeros(shape=x_train.shape[1]))
+                setattr(m, weight_attr, np.zeros(shape=x_t.shape[1]))
                 warnings.warn(f'Set all weights to zero: {str(err)}')
                 if calc_scores:
                     scores[t] = 0
-            all_ms.append(get_model_weights(m, weight_attr, equal_weights,
-                                            0, t))
+            all_ms.append(expand_weights(
+                get_model_weights(m, weight_attr, equal_weights, 0, t),
+                cols, p))
             m = clone(estimator=m)
         if metalearner:
             final_m = dict(zip(treatment_classes, all_ms))
@@ -146,6 +195,9 @@ def calc_var_imp(x_train, t_train, y_train, m, weight_attr,
             final_m = sum(all_ms) / len(treatment_classes)
     else:
         t_dummy = pd.get_dummies(t_train, drop_first=True).to_numpy()
+        cols = screen_covariates(x_train, y_train, screen)
+        if cols is not None:
+            x_train = x_train[:, cols]
         try:
             m.fit(np.concatenate([x_train, t_dummy], axis=1), y_train)
             if calc_scores:
@@ -157,14 +209,551 @@ def calc_var_imp(x_train, t_train, y_train, m, weight_attr,
             warnings.warn(f'Set all weights to zero: {str(err)}')
             if calc_scores:
                 scores['all'] = 0
-        final_m = get_model_weights(m, weight_attr, equal_weights,
-                                    t_dummy.shape[1], 'all')
+        final_m = expand_weights(
+            get_model_weights(m, weight_attr, equal_weights,
+                              t_dummy.shape[1], 'all'), cols, p)
     return final_m, scores
 
 
+def screen_covariates(x, y, screen):
+    """Sure independence screening. Rank the covariates by the absolute value
+    of their marginal correlation with the outcome, computed for all
+    covariates with one matrix-vector product.
+
+    Parameters
+    ----------
+    x : np.array
+        Matrix of covariates.
+    y : np.array
+        Vector of outcomes.
+    screen : None or int
+        Number of covariates to keep.
+
+    Returns
+    -------
+    None or np.array
+        Sorted indices of the screen covariates with the largest absolute
+        correlation. None if screen is None or at least the number of
+        covariates.
+    """
+    if screen is None or screen >= x.shape[1]:
+        return None
+    y_centered = y - y.mean()
+    std = x.std(axis=0)
+    corr = np.abs(y_centered @ x) / np.where(std > 0, std, np.inf)
+    return np.sort(np.argsort(-corr, kind='stable')[:screen])
+
+
+def expand_weights(weights, cols, p):
+    """Expand the weights of the screened covariates cols to all p
+    covariates, with zero weight for the others, keeping weights that sum to
+    the number of covariates."""
+    if cols is None:
+        return weights
+    all_weights = np.zeros(p)
+    all_weights[cols] = weights * p / len(cols)
+    return all_weights
+
+
+GRAM_LASSO_PARAMS = {'max_iter', 'tol', 'cv', 'eps', 'n_alphas', 'alphas',
+                     'random_state'}
+
+
+def use_gram_lasso(model, params, weight_attr, binary_outcome, screen=None,
+                   shape=None):
+    """Whether the variable importances can be learned with GramLassoCV
+    instead of one LassoCV per split. Not used with screening, since the
+    Gram matrix of all covariates costs more than fitting the screened
+    ones, or with fewer than 8 samples per covariate in shape, where
+    updating the p x p Gram matrices costs more than the LassoCV fits."""
+    return (isinstance(model, str) and model == 'linear' and
+            weight_attr is None and not binary_outcome and screen is None and
+            (shape is None or shape[0] >= 8 * shape[1]) and
+            (params is None or (set(params) <= GRAM_LASSO_PARAMS and
+                                isinstance(params.get('cv', 5), int))))
+
+
+def calc_var_imp_gram(X, T, Y, split_strategy, params=None,
+                      separate_treatments=True, equal_weights=False,
+                      metalearner=False, calc_scores=True, n_jobs=None):
+    """Calculate the LASSO variable importances of every split from one
+    GramLassoCV per treatment class. Matches calling calc_var_imp() with a
+    LassoCV on the training set of each split.
+
+    Parameters
+    ----------
+    X : np.array
+        Matrix with covariate values for all samples.
+    T : np.array
+        Vector with treatment values for all samples.
+    Y : np.array
+        Vector with outcome values for all samples.
+    split_strategy : list[tuple]
+        (estimation indices, training indices) of each split.
+    params : None or dict, default=None
+        LassoCV parameters. Must be a subset of GRAM_LASSO_PARAMS and cv must
+        be an int.
+    separate_treatments, equal_weights, metalearner, calc_scores
+        See calc_var_imp().
+    n_jobs : None or int, default=None
+        Number of threads used to fit the treatment classes in parallel.
+
+    Returns
+    -------
+    list[tuple]
+        (final_m, scores) of each split. See calc_var_imp().
+    """
+    params = {} if params is None else dict(params)
+    params.pop('random_state', None)
+    params.setdefault('max_iter', 5000)
+    treatment_classes = np.unique(T)
+    if metalearner or separate_treatments:
+        groups = [(t, np.where(T == t)[0], X[T == t]) for t in
+                  treatment_classes]
+        t_covs = 0
+    else:
+        t_dummy = pd.get_dummies(T, drop_first=True).to_numpy(dtype=float)
+        groups = [('all', np.arange(X.shape[0]),
+                   np.concatenate([X, t_dummy], axis=1))]
+        t_covs = t_dummy.shape[1]
+
+    def fit_group(t, rows, X_group):
+        lasso = GramLassoCV(X_group, Y[rows], **params)
+        results = []
+        for _, train_idx in split_strategy:
+            try:
+                lasso.fit_rows(np.isin(rows, train_idx))
+                score = lasso.score_
+            except ValueError as err:
+                lasso.coef_ = np.zeros(X_group.shape[1])
+                warnings.warn(f'Set all weights to zero: {str(err)}')
+                score = 0
+            results.append((get_model_weights(lasso, 'coef_', equal_weights,
+                                              t_covs, t), score))
+        return results
+
+    group_results = Parallel(n_jobs=n_jobs, prefer='threads')(
+        delayed(fit_group)(*group) for group in groups)
+    all_results = []
+    for i in range(len(split_strategy)):
+        all_ms = [results[i][0] for results in group_results]
+        scores = {}
+        if calc_scores:
+            scores = {group[0]: results[i][1] for group, results in
+                      zip(groups, group_results)}
+        if metalearner:
+            final_m = dict(zip(treatment_classes, all_ms))
+        elif separate_treatments:
+            final_m = sum(all_ms) / len(treatment_classes)
+        else:
+            final_m = all_ms[0]
+        all_results.append((final_m, scores))
+    return all_results
+
+
+def lasso_stats(X, y):
+    """Sums needed to fit and score a LASSO on the rows of X and y without
+    the rows: count, column sums, and cross products."""
+    return {'n': X.shape[0], 'sx': X.sum(axis=0), 'sy': y.sum(),
+            'xx': X.T @ X, 'xy': X.T @ y, 'yy': y @ y}
+
+
+class GramLassoCV:
+    """
+    LassoCV that can be fit to many subsets of the rows of one dataset, e.g.
+    the training sets of the splits of VIM_CF. X^T X, X^T y, and the sums of
+    X and y are computed once for all rows. The statistics of a training set
+    are derived by subtracting its held out rows and the statistics of each
+    cross validation fold by subtracting the fold, and lasso_path is run on
+    the resulting centered Gram matrices instead of on the rows. As in
+    LassoCV, the alpha grid of each fit is computed from its training rows,
+    here from their centered X^T y. lasso_path warm starts each alpha of a
+    path from the previous one, and the refit at the best alpha is warm
+    started from the mean of the fold coefficients.
+
+    Parameters
+    ----------
+    X : np.array
+        Matrix of covariates of all rows.
+    y : np.array
+        Vector of outcomes of all rows.
+    cv : int, default=5
+        Number of unshuffled cross validation folds, as in LassoCV.
+    n_alphas : int, default=100
+        Number of alphas in the grid.
+    alphas : None, int, or list type, default=None
+        If list type, the alpha grid. If int, the number of alphas.
+    eps : float, default=1e-3
+        Ratio of the smallest to the largest alpha of the grid.
+    max_iter : int, default=5000
+        Maximum number of coordinate descent iterations.
+    tol : float, default=1e-4
+        Coordinate descent tolerance.
+
+    Attributes
+    ----------
+    alphas_ : np.array
+        Alpha grid of the last fit.
+    coef_ : np.array
+        Coefficients of the last fit.
+    alpha_ : float
+        Alpha chosen by cross validation in the last fit.
+    score_ : float
+        R^2 of the last fit on its training rows.
+    """
+    def __init__(self, X, y, cv=5, n_alphas=100, alphas=None, eps=1e-3,
+                 max_iter=5000, tol=1e-4):
+        # shift by the mean of all rows so that centering each subset of rows
+        # with the sums below does not lose precision
+        self.X = np.asarray(X, dtype=np.float64)
+        self.X = self.X - self.X.mean(axis=0)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.y = self.y - self.y.mean()
+        self.cv = cv
+        self.max_iter = max_iter
+        self.tol = tol
+        self.stats = lasso_stats(self.X, self.y)
+        if isinstance(alphas, int):
+            n_alphas, alphas = alphas, None
+        self.n_alphas = n_alphas
+        self.alphas = None if alphas is None else np.sort(alphas)[::-1]
+        self.eps = eps
+        self.coef_ = np.zeros(self.X.shape[1])
+
+    def fit_rows(self, train_mask):
+        """Fit LassoCV to the rows where train_mask is True.
+
+        Parameters
+        ----------
+        train_mask : np.array
+            Boolean vector of the rows to fit to.
+
+        Raises
+        ------
+        ValueError
+            Fewer training rows than folds.
+        """
+        train_rows = np.where(train_mask)[0]
+        n_train = train_rows.shape[0]
+        if n_train < self.cv:
+            raise ValueError(f'Cannot have number of splits n_splits='
+                             f'{self.cv} greater than the number of samples: '
+                             f'n_samples={n_train}.')
+        train = self.subtract(self.stats, np.where(~train_mask)[0])
+        self.alphas_ = self.alpha_grid(train)
+        mse = np.zeros(len(self.alphas_))
+        fold_sizes = np.full(self.cv, n_train // self.cv)
+        fold_sizes[:n_train % self.cv] += 1
+        bounds = np.concatenate([[0], np.cumsum(fold_sizes)])
+        fold_coefs = []
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            test_rows = train_rows[start:stop]
+            fold_train = self.subtract(train, test_rows)
+            coefs = self.path(fold_train, self.alphas_,
+                              np.zeros(self.X.shape[1]),
+                              np.delete(train_rows, np.s_[start:stop]))
+            intercepts = (fold_train['sy'] - fold_train['sx'] @ coefs) / \
+                fold_train['n']
+            residuals = self.X[test_rows] @ coefs + intercepts - \
+                self.y[test_rows, None]
+            mse += np.mean(residuals ** 2, axis=0)
+            fold_coefs.append(coefs)
+        best = np.argmin(mse)
+        self.alpha_ = self.alphas_[best]
+        coef_init = np.mean([coefs[:, best] for coefs in fold_coefs], axis=0)
+        self.coef_ = self.path(train, [self.alpha_], coef_init,
+                               train_rows)[:, 0]
+        gram, xy, yy = self.centered(train)
+        self.score_ = 1 - (yy - 2 * self.coef_ @ xy +
+                           self.coef_ @ gram @ self.coef_) / yy \
+            if yy > 0 else 0
+        return self
+
+    def alpha_grid(self, stats):
+        """Alpha grid of LassoCV for the rows in stats."""
+        if self.alphas is not None:
+            return self.alphas
+        alpha_max = np.abs(self.centered(stats)[1]).max() / stats['n']
+        if alpha_max <= np.finfo(np.float64).resolution:
+            return np.full(self.n_alphas, np.finfo(np.float64).resolution)
+        return np.geomspace(alpha_max, alpha_max * self.eps,
+                            num=self.n_alphas)
+
+    def subtract(self, stats, rows):
+        """Statistics of the rows in stats that are not in rows."""
+        removed = lasso_stats(self.X[rows], self.y[rows])
+        return {key: stats[key] - removed[key] for key in stats}
+
+    @staticmethod
+    def centered(stats):
+        """Gram matrix, X^T y, and y^T y of the centered rows in stats."""
+        mean_x = stats['sx'] / stats['n']
+        mean_y = stats['sy'] / stats['n']
+        gram = stats['xx'] - stats['n'] * np.outer(mean_x, mean_x)
+        xy = stats['xy'] - stats['n'] * mean_x * mean_y
+        yy = stats['yy'] - stats['n'] * mean_y ** 2
+        return gram, xy, yy
+
+    def path(self, stats, alphas, coef_init, rows):
+        """Run lasso_path from the statistics of the rows."""
+        gram, xy, _ = self.centered(stats)
+        # lasso_path only uses X for its shape when given the Gram matrix
+        X_shape = np.broadcast_to(np.zeros(1), (stats['n'], self.X.shape[1]))
+        y = self.y[rows] - stats['sy'] / stats['n']
+        _, coefs, _ = linear.lasso_path(
+            X_shape, y, alphas=alphas, precompute=np.ascontiguousarray(gram),
+            Xy=xy, copy_X=False, coef_init=coef_init, check_input=False,
+            max_iter=self.max_iter, tol=self.tol)
+        return coefs
+
+
+L1_PATH_PARAMS = {'Cs', 'cv', 'max_iter', 'cd_max_iter', 'tol', 'n_jobs',
+                  'random_state'}
+
+
+class L1LogisticPath(BaseEstimator, ClassifierMixin):
+    """
+    L1 penalized logistic regression with the penalty chosen by stratified
+    cross validation, like LogisticRegressionCV(penalty='l1'). Each fold is
+    fit along the whole C grid from the strongest penalty with
+    l1_logistic_path(), which warm starts each C from the previous one and
+    screens covariates with the sequential strong rule. The folds are fit in
+    parallel.
+
+    Parameters
+    ----------
+    Cs : int or list type, default=10
+        If int, the C grid is np.logspace(-4, 4, Cs). Otherwise, the C grid.
+    cv : int, default=5
+        Number of stratified cross validation folds.
+    max_iter : int, default=100
+        Maximum number of proximal Newton iterations for each C.
+    cd_max_iter : int, default=10000
+        Maximum number of coordinate descent iterations of each proximal
+        Newton step.
+    tol : float, default=1e-4
+        Tolerance of the proximal Newton and coordinate descent updates.
+    n_jobs : None or int, default=None
+        Number of threads used to fit the folds in parallel.
+    random_state : None or int, default=None
+        Unused. Accepted so that config_model() can set it.
+
+    Attributes
+    ----------
+    classes_ : np.array
+        The two outcome classes.
+    Cs_ : np.array
+        C grid.
+    C_ : float
+        C with the highest mean cross validation accuracy.
+    coef_ : np.array
+        Coefficients of shape (1, p) fit to all samples with C_.
+    intercept_ : np.array
+        Intercept of shape (1,).
+    """
+    def __init__(self, Cs=10, cv=5, max_iter=100, cd_max_iter=10000,
+                 tol=1e-4, n_jobs=None, random_state=None):
+        self.Cs = Cs
+        self.cv = cv
+        self.max_iter = max_iter
+        self.cd_max_iter = cd_max_iter
+        self.tol = tol
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+
+    def fit(self, X, y):
+        """Choose C by cross validation and fit to all samples.
+
+        Raises
+        ------
+        ValueError
+            The outcome does not have exactly two classes.
+        """
+        X = np.asarray(X, dtype=np.float64)
+        self.classes_ = np.unique(y)
+        if len(self.classes_) != 2:
+            raise ValueError(f'L1LogisticPath needs an outcome with 2 '
+                             f'classes, got {len(self.classes_)}')
+        y = (np.asarray(y) == self.classes_[1]).astype(np.float64)
+        self.Cs_ = np.logspace(-4, 4, self.Cs) if isinstance(self.Cs, int) \
+            else np.sort(self.Cs)
+        folds = list(StratifiedKFold(n_splits=self.cv).split(X, y))
+        paths = Parallel(n_jobs=self.n_jobs, prefer='threads')(
+            delayed(l1_logistic_path)(X[train_idx], y[train_idx], self.Cs_,
+                                      max_iter=self.max_iter,
+                                      cd_max_iter=self.cd_max_iter,
+                                      tol=self.tol)
+            for train_idx, _ in folds)
+        accuracy = np.zeros(len(self.Cs_))
+        for (_, test_idx), (coefs, intercepts) in zip(folds, paths):
+            decision = X[test_idx] @ coefs.T + intercepts
+            accuracy += np.mean((decision > 0) == (y[test_idx, None] == 1),
+                                axis=0)
+        best = np.argmax(accuracy)
+        self.C_ = self.Cs_[best]
+        coefs = np.mean([coefs for coefs, _ in paths], axis=0)
+        intercepts = np.mean([intercepts for _, intercepts in paths], axis=0)
+        coef, intercept = l1_logistic_path(
+            X, y, [self.C_], ([coefs[best]], [intercepts[best]]),
+            self.max_iter, self.tol, self.cd_max_iter)
+        self.coef_ = coef.reshape(1, -1)
+        self.intercept_ = intercept
+        return self
+
+    def decision_function(self, X):
+        """Log odds of the second class."""
+        return np.asarray(X) @ self.coef_[0] + self.intercept_[0]
+
+    def predict(self, X):
+        """Predicted class."""
+        return self.classes_[(self.decision_function(X) > 0).astype(int)]
+
+
+def l1_logistic_path(X, y, Cs, coefs_init=None, max_iter=100, tol=1e-4,
+                     cd_max_iter=10000):
+    """Fit L1 penalized logistic regressions, minimizing
+    C * sum(log loss) + ||w||_1 with an unpenalized intercept, for each C in
+    increasing order. Each C is warm started from the previous solution. The
+    sequential strong rule discards the covariates whose log loss gradient
+    is below 2 / (C n) - 1 / (C_prev n) at the previous solution, the rest
+    are fit with l1_logistic_newton(), and discarded covariates that violate
+    the optimality conditions are added back until none do.
+
+    Parameters
+    ----------
+    X : np.array
+        Matrix of covariates.
+    y : np.array
+        Vector of 0/1 outcomes.
+    Cs : list type
+        Increasing inverse penalties.
+    coefs_init : None or tuple, default=None
+        (coefficients, intercepts) of each C, e.g. the mean of the cross
+        validation paths. Each
+        C is warm started from them instead of the previous solution when
+        they have a lower objective.
+    max_iter : int, default=100
+        Maximum number of proximal Newton iterations for each C.
+    tol : float, default=1e-4
+        Tolerance of the proximal Newton and coordinate descent updates.
+    cd_max_iter : int, default=10000
+        Maximum number of coordinate descent iterations of each proximal
+        Newton step.
+
+    Returns
+    -------
+    coefs : np.array
+        Coefficients of shape (len(Cs), p).
+    intercepts : np.array
+        Intercepts of shape (len(Cs),).
+    """
+    n, p = X.shape
+    mean_y = np.clip(y.mean(), 1e-10, 1 - 1e-10)
+    w = np.zeros(p)
+    b = np.log(mean_y / (1 - mean_y))
+    coefs = np.zeros((len(Cs), p))
+    intercepts = np.zeros(len(Cs))
+    grad = X.T @ (expit(X @ w + b) - y) / n
+    lam_prev = np.abs(grad).max()
+    for i, C in enumerate(Cs):
+        lam = 1 / (C * n)
+        if coefs_init is not None and \
+                l1_logistic_objective(X, y, lam, coefs_init[0][i],
+                                      coefs_init[1][i]) < \
+                l1_logistic_objective(X, y, lam, w, b):
+            w = np.copy(coefs_init[0][i])
+            b = coefs_init[1][i]
+            grad = X.T @ (expit(X @ w + b) - y) / n
+        threshold = 2 * lam - lam_prev
+        # the strong rule keeps everything when the grid is coarse; keep the
+        # covariates that violate the optimality conditions instead
+        working = (np.abs(grad) >= (threshold if threshold > 0 else lam)) | \
+            (w != 0)
+        while True:
+            w, b = l1_logistic_newton(X, y, lam, w, b, working, max_iter, tol,
+                                      cd_max_iter)
+            grad = X.T @ (expit(X @ w + b) - y) / n
+            violations = ~working & (np.abs(grad) > lam)
+            if not violations.any():
+                break
+            working |= violations
+        coefs[i] = w
+        intercepts[i] = b
+        lam_prev = lam
+    return coefs, intercepts
+
+
+def l1_logistic_objective(X, y, lam, w, b):
+    """mean(log loss) + lam * ||w||_1 of a logistic regression."""
+    z = X @ w + b
+    return np.mean(np.logaddexp(0, z) - y * z) + lam * np.abs(w).sum()
+
+
+def l1_logistic_newton(X, y, lam, w, b, working, max_iter=100, tol=1e-4,
+                       cd_max_iter=10000):
+    """Minimize mean(log loss) + lam * ||w||_1 over the working covariates
+    with proximal Newton steps. Each step solves the weighted LASSO of the
+    quadratic approximation with lasso_path on its Gram matrix and is
+    followed by a backtracking line search. The other coefficients are set
+    to zero."""
+    n = X.shape[0]
+    cols = np.where(working)[0]
+    w = np.where(working, w, 0)
+    if len(cols) == 0:
+        mean_y = np.clip(y.mean(), 1e-10, 1 - 1e-10)
+        return w, np.log(mean_y / (1 - mean_y))
+    X_w = X[:, cols]
+    w_w = w[cols]
+    z = X_w @ w_w + b
+    objective = np.mean(np.logaddexp(0, z) - y * z) + \
+        lam * np.abs(w_w).sum()
+    for _ in range(max_iter):
+        prob = expit(z)
+        weights = np.maximum(prob * (1 - prob), 1e-5)
+        response = z + (y - prob) / weights
+        mean_x = weights @ X_w / weights.sum()
+        mean_response = weights @ response / weights.sum()
+        sqrt_weights = np.sqrt(weights)
+        X_scaled = (X_w - mean_x) * sqrt_weights[:, None]
+        y_scaled = sqrt_weights * (response - mean_response)
+        gram = X_scaled.T @ X_scaled
+        xy = X_scaled.T @ y_scaled
+        # lasso_path only uses X for its shape when given the Gram matrix
+        X_shape = np.broadcast_to(np.zeros(1), (n, len(cols)))
+        _, step, _ = linear.lasso_path(
+            X_shape, y_scaled, alphas=[lam],
+            precompute=np.ascontiguousarray(gram), Xy=xy,
+            copy_X=False, coef_init=w_w, check_input=False,
+            max_iter=cd_max_iter, tol=tol)
+        step = step[:, 0] - w_w
+        step_b = mean_response - mean_x @ (w_w + step) - b
+        decrease = (X_w.T @ (prob - y)) @ step / n + \
+            np.mean(prob - y) * step_b + \
+            lam * (np.abs(w_w + step).sum() - np.abs(w_w).sum())
+        t = 1
+        while True:
+            z_t = X_w @ (w_w + t * step) + b + t * step_b
+            objective_t = np.mean(np.logaddexp(0, z_t) - y * z_t) + \
+                lam * np.abs(w_w + t * step).sum()
+            if objective_t <= objective + 0.25 * t * decrease or t < 1e-8:
+                break
+            t /= 2
+        w_w = w_w + t * step
+        b = b + t * step_b
+        z = z_t
+        objective = objective_t
+        if t * max(np.abs(step).max(), abs(step_b)) <= \
+                tol * max(1, np.abs(w_w).max()):
+            break
+    w[cols] = w_w
+    return w, b
+
+
 def get_match_groups(df_estimation, covariates, treatment, M, k=None,
-                     return_original_idx=True,
-                     check_est_df=True):
+                     check_est_df=True, nn_engine='auto', nn_params=None,
+                     df_reference=None, nn_index=None, diameters_only=False,
+                     dedup=False, block_on=None, n_jobs=None,
+                     metric='cityblock', dtype='float64'):
     """Calculate match groups for an estimation dataset.
 
     Parameters
@@ -181,75 +770,1288 @@ def get_match_groups(df_estimation, covariates, treatment, M, k=None,
         Covariate weights. Must be in same order as covariates argument.
     k : int
         Match group size for each treatment.
-    return_original_idx : bool, default=True
-        Whether to return the match groups with the values of the original
-        df_estimation index. If False, the matches correspond to the row #
-        of the sample in df_estimation (i.e. the index after .reset_index()
-        is run).
     check_est_df : bool, default=True
         Whether to check the df_estimation for the appropriate columns
         before running.
+    nn_engine : str, default='auto'
+        Nearest neighbor engine to use. See config_nn() for accepted values.
+    nn_params : None or dict, default=None
+        Additional parameters passed to the nearest neighbor engine.
+    df_reference : None or pd.DataFrame, default=None
+        If None, samples in df_estimation are matched to each other.
+        Otherwise, samples in df_estimation are matched to the samples in
+        df_reference and the returned matches refer to df_reference. In this
+        case df_estimation does not need a treatment column.
+    nn_index : None or dict, default=None
+        Nearest neighbor objects already fit to each treatment class of
+        df_reference, as returned from build_nn_index(). If None, they are fit
+        here.
+    diameters_only : bool, default=False
+        Whether to only keep the diameter of each match group (i.e. the
+        distance to the farthest match) instead of all the match distances.
+    dedup : bool, default=False
+        Whether to collapse identical weighted covariate rows before the
+        nearest neighbor search and broadcast the matches back to every
+        duplicate. See DedupNN.
+    block_on : None or str, default=None
+        If not None, label of a column with the block of each sample (e.g. a
+        site or school id). Samples are only matched to samples in the same
+        block, using a separate nearest neighbor object for each block. Every
+        block must have at least k samples of each treatment class.
+    n_jobs : None or int, default=None
+        Number of threads used to search the blocks. Only used if block_on is
+        not None.
+    metric : str, default='cityblock'
+        Distance between the weighted covariates. Either 'cityblock' or
+        'euclidean'. See config_nn().
+    dtype : str, default='float64'
+        Precision of the covariates used for matching. If 'float32', the
+        covariates, weighted covariates, and distances are kept in float32.
+        This halves the memory of the search itself only with
+        nn_engine='numba', 'early_abandon', or 'brute' with
+        metric='euclidean'. The sklearn tree, LowDimNN, and the cityblock
+        brute force search convert to float64 internally, so there only the
+        covariate matrices are halved. If 'int8', the covariates must be
+        integers between -128 and 127 (e.g. dummies) and are stored as int8
+        and weighted in float32.
 
     Returns
     -------
     match_groups
-        Match groups for each sample in df_estimation.
-    match_distances
-        Distance between each match, corresponding the matches in match_groups.
+        MatchGroups with the match groups and match distances of each sample
+        in df_estimation. Use match_groups.to_frames() to export them as
+        dataframes.
     """
+    block_cols = [] if block_on is None else [block_on]
     if check_est_df:
         check_df_estimation(df_cols=df_estimation.columns,
-                            necessary_cols=covariates + [treatment])
-    old_idx = np.array(df_estimation.index)
-    df_estimation = df_estimation.reset_index(drop=True)
-    X = df_estimation[covariates].to_numpy()
-    T = df_estimation[treatment].to_numpy()
-    match_groups = {}
-    match_distances = {}
-    for t in np.unique(T):
+                            necessary_cols=covariates + block_cols + (
+                                [treatment] if df_reference is None else []))
+    if (nn_index is not None) and (df_reference is None):
+        raise Exception('df_reference must be passed with nn_index')
+    X = covariate_matrix(df_estimation, covariates, dtype)
+    if df_reference is None:
+        return get_match_groups_arrays(
+            X, df_estimation[treatment].to_numpy(), M, k=k,
+            index=df_estimation.index, nn_engine=nn_engine,
+            nn_params=nn_params, diameters_only=diameters_only, dedup=dedup,
+            blocks=(None if block_on is None else
+                    df_estimation[block_on].to_numpy()),
+            n_jobs=n_jobs, metric=metric)
+    return get_match_groups_arrays(
+        X, None, M, k=k, index=df_estimation.index,
+        X_ref=covariate_matrix(df_reference, covariates, dtype),
+        T_ref=df_reference[treatment].to_numpy(),
+        ref_index=df_reference.index, nn_engine=nn_engine,
+        nn_params=nn_params, nn_index=nn_index, diameters_only=diameters_only,
+        dedup=dedup,
+        blocks=None if block_on is None else df_estimation[block_on].to_numpy(),
+        ref_blocks=(None if block_on is None else
+                    df_reference[block_on].to_numpy()),
+        n_jobs=n_jobs, metric=metric)
+
+
+def get_match_groups_arrays(X, T, M, k=None, index=None, X_ref=None,
+                            T_ref=None, ref_index=None, nn_engine='auto',
+                            nn_params=None, nn_index=None,
+                            diameters_only=False, dedup=False, blocks=None,
+                            ref_blocks=None, n_jobs=None, metric='cityblock'):
+    """Calculate match groups for arrays of samples. Array level version of
+    get_match_groups() that does not copy the samples into dataframes.
+
+    Parameters
+    ----------
+    X : np.array
+        Covariates of the samples to match, as returned by matching_array().
+    T : None or np.array
+        Treatments of the samples. Only needed if X_ref is None.
+    M : np.array or dict
+        Covariate weights. Must be in same order as the columns of X.
+    k : int
+        Match group size for each treatment.
+    index : None or np.array, default=None
+        Index labels of the samples. If None, their row numbers.
+    X_ref : None or np.array, default=None
+        If None, the samples are matched to each other. Otherwise, covariates
+        of the reference samples they are matched to.
+    T_ref : None or np.array, default=None
+        Treatments of the reference samples. Required with X_ref.
+    ref_index : None or np.array, default=None
+        Index labels of the reference samples. If None, their row numbers.
+    nn_engine : str, default='auto'
+        Nearest neighbor engine to use. See config_nn() for accepted values.
+    nn_params : None or dict, default=None
+        Additional parameters passed to the nearest neighbor engine.
+    nn_index : None or dict, default=None
+        Nearest neighbor objects already fit to each treatment class of
+        X_ref, as returned from build_nn_index().
+    diameters_only : bool, default=False
+        Whether to only keep the diameter of each match group.
+    dedup : bool, default=False
+        Whether to collapse identical weighted covariate rows before the
+        nearest neighbor search. See DedupNN.
+    blocks : None or np.array, default=None
+        If not None, block of each sample. Samples are only matched to
+        reference samples in the same block. See BlockNN.
+    ref_blocks : None or np.array, default=None
+        Block of each reference sample. Required with blocks and X_ref.
+    n_jobs : None or int, default=None
+        Number of threads used to search the blocks.
+    metric : str, default='cityblock'
+        Distance between the weighted covariates. See config_nn().
+
+    Returns
+    -------
+    match_groups
+        MatchGroups with the match groups and match distances of each sample.
+    """
+    index = np.arange(X.shape[0]) if index is None else np.asarray(index)
+    if X_ref is None:
+        X_ref, T_ref, ref_index, ref_blocks = X, T, index, blocks
+    elif ref_index is None:
+        ref_index = np.arange(X_ref.shape[0])
+    T_ref = np.asarray(T_ref)
+    groups = {}
+    distances = {}
+    abandon_stats = {}
+    for t in np.unique(T_ref):
         if type(M) == dict:
             weights = M[t]
         else:
             weights = M
-        this_X = weights[weights > 0] * X[:, weights > 0]
-        this_dist, this_mg = get_nn(this_X, T, treatment=t, k=k)
-        match_groups[t] = this_mg
-        match_distances[t] = this_dist
-    for t in np.unique(T):
-        match_groups[t] = pd.DataFrame(np.array(df_estimation.loc[T == t].index)[match_groups[t]])
-        match_distances[t] = pd.DataFrame(match_distances[t])
-        if return_original_idx:
-            match_groups[t] = convert_idx(match_groups[t], old_idx)
-            match_distances[t].index = old_idx
-    return match_groups, match_distances
+        if nn_index is not None:
+            nn = nn_index[t]
+        elif blocks is None:
+            nn = config_nn(k=k, nn_engine=nn_engine, nn_params=nn_params,
+                           weights=weights[weights > 0], dedup=dedup,
+                           metric=metric).fit(
+                weight_covariates(X_ref[T_ref == t], weights))
+        else:
+            nn = BlockNN(n_neighbors=k, nn_engine=nn_engine,
+                         nn_params=nn_params, weights=weights[weights > 0],
+                         dedup=dedup, n_jobs=n_jobs, metric=metric).fit(
+                weight_covariates(X_ref[T_ref == t], weights),
+                ref_blocks[T_ref == t])
+        if blocks is None:
+            this_dist, this_mg = nn.kneighbors(weight_covariates(X, weights),
+                                               n_neighbors=k,
+                                               return_distance=True)
+        else:
+            this_dist, this_mg = nn.kneighbors(weight_covariates(X, weights),
+                                               blocks, n_neighbors=k,
+                                               return_distance=True)
+        groups[t] = np.flatnonzero(T_ref == t).astype(np.int32)[this_mg]
+        abandon_stats[t] = get_abandon_stats(nn)
+        if diameters_only:
+            distances[t] = this_dist[:, -1].astype(np.float32)
+        else:
+            distances[t] = this_dist.astype(np.float32)
+    if all(stats is None for stats in abandon_stats.values()):
+        abandon_stats = None
+    return MatchGroups(groups, distances, index=index, ref_index=ref_index,
+                       diameters_only=diameters_only,
+                       abandon_stats=abandon_stats)
+
+
+class MatchGroups:
+    """Array backed match groups and match distances for each treatment class.
+
+    Matches are stored as row numbers of the reference samples (i.e. the
+    index after .reset_index() is run) and are only translated to the
+    original index labels on demand.
+
+    Parameters
+    ----------
+    groups : dict[int,np.array]
+        For each treatment class, int32 array of shape (n, k) with the row
+        numbers of the matched samples.
+    distances : dict[int,np.array]
+        For each treatment class, float32 array of shape (n, k) with the
+        distance to each match or, if diameters_only, of shape (n,) with the
+        diameter of each match group.
+    index : np.array
+        Index labels of the n matched samples.
+    ref_index : None or np.array, default=None
+        Index labels of the reference samples the row numbers in groups refer
+        to. If None, set to index.
+    diameters_only : bool, default=False
+        Whether distances only holds the match group diameters.
+    abandon_stats : None or dict, default=None
+        For each treatment class, the get_abandon_stats() of the
+        nn_engine='early_abandon' search. With a reused nn_index, the
+        counters include earlier searches with the same index.
+    """
+    def __init__(self, groups, distances, index, ref_index=None,
+                 diameters_only=False, abandon_stats=None):
+        self.groups = groups
+        self.distances = distances
+        self.index = np.asarray(index)
+        self.ref_index = self.index if ref_index is None else \
+            np.asarray(ref_index)
+        self.diameters_only = diameters_only
+        self.abandon_stats = abandon_stats
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    @property
+    def k(self):
+        """Match group size for each treatment class."""
+        return next(iter(self.groups.values())).shape[1]
+
+    def subset(self, k):
+        """Get the match groups of size k. Since the matches of each sample
+        are sorted by distance, these are the first k matches."""
+        if k > self.k:
+            raise Exception(f'Cannot get match groups of size {k} from match '
+                            f'groups of size {self.k}.')
+        if k == self.k:
+            return self
+        if self.diameters_only:
+            raise Exception('Cannot get smaller match groups when only the '
+                            'diameters were kept.')
+        return MatchGroups({t: mg[:, :k] for t, mg in self.groups.items()},
+                           {t: md[:, :k] for t, md in self.distances.items()},
+                           index=self.index, ref_index=self.ref_index,
+                           abandon_stats=self.abandon_stats)
+
+    @property
+    def treatment_classes(self):
+        """Treatment classes with match groups."""
+        return list(self.groups.keys())
+
+    def diameters(self, t):
+        """Get the diameter of each match group for treatment class t."""
+        if self.diameters_only:
+            return self.distances[t]
+        return self.distances[t][:, -1]
+
+    def labels(self, t):
+        """Get the match groups for treatment class t as index labels."""
+        return self.ref_index[self.groups[t]]
+
+    def to_frames(self, return_original_idx=True):
+        """Export the match groups and match distances as dataframes.
+
+        Parameters
+        ----------
+        return_original_idx : bool, default=True
+            Whether to return the match groups with the original index labels.
+            If False, the matches correspond to the row # of the reference
+            samples and the dataframes have a reset index.
+
+        Returns
+        -------
+        match_groups
+            Dictionary with a dataframe of match groups for each treatment.
+        match_distances
+            Dictionary with a dataframe of match distances for each treatment.
+        """
+        match_groups = {}
+        match_distances = {}
+        for t in self.treatment_classes:
+            if return_original_idx:
+                match_groups[t] = pd.DataFrame(self.labels(t),
+                                               index=self.index)
+                match_distances[t] = pd.DataFrame(self.distances[t],
+                                                  index=self.index)
+            else:
+                match_groups[t] = pd.DataFrame(self.groups[t])
+                match_distances[t] = pd.DataFrame(self.distances[t])
+        return match_groups, match_distances
+
+    @classmethod
+    def from_frames(cls, match_groups, match_distances):
+        """Create MatchGroups from match group and match distance dataframes
+        with row # matches, as returned by to_frames(False)."""
+        index = np.array(next(iter(match_groups.values())).index)
+        return cls({t: mg.to_numpy().astype(np.int32)
+                    for t, mg in match_groups.items()},
+                   {t: md.to_numpy().astype(np.float32)
+                    for t, md in match_distances.items()},
+                   index=index)
+
+
+def build_nn_index(df_reference, covariates, treatment, M, k=None,
+                   nn_engine='auto', nn_params=None, dedup=False,
+                   block_on=None, n_jobs=None, metric='cityblock',
+                   dtype='float64'):
+    """Fit a nearest neighbor object to each treatment class of a reference
+    dataset so it can be reused to match new samples.
+
+    Parameters
+    ----------
+    df_reference : pd.DataFrame
+        Reference dataset that samples are matched to.
+    covariates : list[str]
+        Covariate names.
+    treatment : str
+        Treatment column label.
+    M : np.array or dict
+        Covariate weights. Must be in same order as covariates argument.
+    k : None or int, default=None
+        Default number of neighbors of the nearest neighbor objects. Required
+        by engines that tune their structure to k (e.g. nn_engine='lsh').
+    nn_engine : str, default='auto'
+        Nearest neighbor engine to use. See config_nn() for accepted values.
+    nn_params : None or dict, default=None
+        Additional parameters passed to the nearest neighbor engine.
+    dedup : bool, default=False
+        Whether to collapse identical weighted covariate rows before the
+        nearest neighbor search and broadcast the matches back to every
+        duplicate. See DedupNN.
+    block_on : None or str, default=None
+        If not None, label of a column with the block of each sample. A
+        BlockNN with a separate nearest neighbor object for each block is fit
+        to each treatment class. The same block_on must then be passed to
+        get_match_groups().
+    n_jobs : None or int, default=None
+        Number of threads used to fit and search the blocks. Only used if
+        block_on is not None.
+    metric : str, default='cityblock'
+        Distance between the weighted covariates. Either 'cityblock' or
+        'euclidean'. See config_nn().
+    dtype : str, default='float64'
+        Precision of the covariates used for matching. See
+        get_match_groups(). Queries should use the same dtype.
+
+    Returns
+    -------
+    nn_index
+        Dictionary with a fitted nearest neighbor object for each treatment
+        class of df_reference.
+    """
+    block_cols = [] if block_on is None else [block_on]
+    check_df_estimation(df_cols=df_reference.columns,
+                        necessary_cols=covariates + block_cols + [treatment])
+    X_ref = covariate_matrix(df_reference, covariates, dtype)
+    T_ref = df_reference[treatment].to_numpy()
+    nn_index = {}
+    for t in np.unique(T_ref):
+        weights = M[t] if type(M) == dict else M
+        if block_on is None:
+            nn_index[t] = config_nn(k=k, nn_engine=nn_engine,
+                                    nn_params=nn_params,
+                                    weights=weights[weights > 0],
+                                    dedup=dedup, metric=metric).fit(
+                weight_covariates(X_ref[T_ref == t], weights))
+        else:
+            nn_index[t] = BlockNN(n_neighbors=k, nn_engine=nn_engine,
+                                  nn_params=nn_params,
+                                  weights=weights[weights > 0], dedup=dedup,
+                                  n_jobs=n_jobs, metric=metric).fit(
+                weight_covariates(X_ref[T_ref == t], weights),
+                df_reference[block_on].to_numpy()[T_ref == t])
+    return nn_index
+
+
+def weight_covariates(X, weights):
+    """Scale covariates by their weights, dropping zero weight covariates.
+    Float32 and int8 covariates are weighted in float32."""
+    if X.dtype in [np.float32, np.int8]:
+        return weights[weights > 0].astype(np.float32) * X[:, weights > 0]
+    return weights[weights > 0] * X[:, weights > 0]
+
+
+def covariate_matrix(df, covariates, dtype='float64'):
+    """Get the covariates of a dataframe as an array of the matching dtype,
+    either 'float64', 'float32', or 'int8'."""
+    if dtype in ['float64', 'float32']:
+        return df[covariates].to_numpy(dtype=dtype)
+    return matching_array(df[covariates].to_numpy(dtype=np.float64), dtype)
+
+
+def matching_array(X, dtype='float64'):
+    """Get a covariate array in the matching dtype, either 'float64',
+    'float32', or 'int8'. Arrays already in dtype are not copied."""
+    if dtype in ['float64', 'float32']:
+        return np.asarray(X, dtype=dtype)
+    elif dtype == 'int8':
+        X_int = np.asarray(X).astype(np.int8, copy=False)
+        if not np.array_equal(X_int, X):
+            raise Exception('Covariates must be integers between -128 and '
+                            '127 to match with dtype=int8.')
+        return X_int
+    raise Exception(f'dtype {dtype} not supported. Supported dtypes are: '
+                    f'float64, float32, and int8.')
+
+
+def float_array(X):
+    """Get X as a contiguous float32 array if it is float32 and as a float64
+    array otherwise."""
+    X = np.asarray(X)
+    return np.ascontiguousarray(
+        X, dtype=np.float32 if X.dtype == np.float32 else np.float64)
+
+
+def get_nn(X, T, treatment, k=None, nn_engine='auto', nn_params=None,
+           metric='cityblock', weights=None, return_nn=False):
+    """Get the k nn of a particular treatment for each sample. weights are
+    the weights the columns of X were scaled by, passed to config_nn(). If
+    return_nn, the fitted nearest neighbor object is also returned, e.g. to
+    read get_abandon_stats() from it."""
+    nn = config_nn(k=k, nn_engine=nn_engine, nn_params=nn_params,
+                   weights=weights, metric=metric).fit(X[T == treatment])
+    dist, idx = nn.kneighbors(X, return_distance=True)
+    if return_nn:
+        return dist, idx, nn
+    return dist, idx
+
+
+def get_abandon_stats(nn):
+    """Get the abandon_stats_ of an EarlyAbandonNN, also when wrapped in
+    DedupNN or BlockNN, in which case the counters of the blocks are summed.
+    None for other engines."""
+    if isinstance(nn, DedupNN):
+        return get_abandon_stats(nn.nn)
+    if isinstance(nn, BlockNN):
+        block_stats = [get_abandon_stats(block_nn) for block_nn in
+                       nn.nn_.values()]
+        if any(stats is None for stats in block_stats):
+            return None
+        stats = {key: sum(s[key] for s in block_stats) for key in
+                 ['candidates', 'column_ops', 'full_column_ops']}
+        stats['fraction_saved'] = 1 - (stats['column_ops'] /
+                                       max(stats['full_column_ops'], 1))
+        return stats
+    stats = getattr(nn, 'abandon_stats_', None)
+    return None if stats is None else dict(stats)
+
+
+def config_nn(k=None, nn_engine='auto', nn_params=None, weights=None,
+              dedup=False, metric='cityblock'):
+    """Configure the nearest neighbor engine used to create match groups.
 
+    Parameters
+    ----------
+    k : int
+        Number of neighbors to return for each query.
+    nn_engine : str, default='auto'
+        If 'auto', uses LowDimNN when weights has one to three entries,
+        passing it the nn_params it accepts (memory_budget) and warning about
+        the others, and a sklearn NearestNeighbors tree with nn_params
+        otherwise. If 'lowdim',
+        uses the exact sorted array (one covariate) or KD tree (two or three
+        covariates) search in LowDimNN. If 'sklearn', uses a sklearn
+        NearestNeighbors tree. If 'brute', uses the exact, chunked brute
+        force search in BruteForceNN. If 'lsh', uses the approximate Cauchy
+        random projection forest in CauchyLSHNN. If 'numba', uses the exact
+        numba compiled search in NumbaNN, falling back to BruteForceNN if
+        numba is not installed. If 'early_abandon', uses the exact numba
+        compiled search in EarlyAbandonNN that stops accumulating a distance
+        once it exceeds the current k-th best, also falling back to
+        BruteForceNN if numba is not installed.
+    nn_params : None or dict, default=None
+        If None, default params are used. Otherwise, dict with parameters
+        passed to the nearest neighbor engine.
+    weights : None or np.array, default=None
+        Weights of the covariates the engine will be fit to. Used by
+        nn_engine='auto' to count the covariates and by
+        nn_engine='early_abandon' to visit covariates in order of decreasing
+        weight.
+    dedup : bool, default=False
+        Whether to wrap the engine in DedupNN so that it only searches the
+        unique rows of the reference and query samples.
+    metric : str, default='cityblock'
+        Distance between the weighted covariates. If 'cityblock', the sum of
+        absolute differences. If 'euclidean', the square root of the sum of
+        squared differences, which nn_engine='brute' computes from
+        ||a||^2 + ||b||^2 - 2ab^T with blocked matrix products. nn_engine=
+        'auto' keeps the sklearn tree for 'euclidean', since sklearn's own
+        algorithm='auto' already switches to a BLAS backed brute force search
+        with more than 15 covariates and was as fast as 'brute' from 4 to
+        1024 covariates, so 'brute' is opt-in, e.g. for its bounded memory.
+        'euclidean' is not supported by nn_engine='numba' or 'early_abandon'.
+
+    Returns
+    -------
+    nn
+        Unfitted nearest neighbor object exposing sklearn style fit() and
+        kneighbors() methods.
+    """
+    if nn_params is None:
+        nn_params = {}
+    if metric not in ['cityblock', 'euclidean']:
+        raise Exception(f'Metric {metric} not supported. Supported metrics '
+                        f'are: cityblock and euclidean.')
+    if (metric != 'cityblock') and (nn_engine in ['numba', 'early_abandon']):
+        raise Exception(f'Nearest neighbor engine {nn_engine} only supports '
+                        f'metric=cityblock.')
+    if nn_engine == 'auto':
+        if (weights is not None) and (1 <= len(weights) <= 3):
+            nn_engine = 'lowdim'
+            dropped = sorted(set(nn_params) - {'memory_budget'})
+            if dropped:
+                warnings.warn(f"nn_engine='auto' uses LowDimNN for "
+                              f"{len(weights)} covariates, which ignores "
+                              f"nn_params {dropped}.")
+            nn_params = {key: value for key, value in nn_params.items()
+                         if key == 'memory_budget'}
+        else:
+            nn_engine = 'sklearn'
+    if nn_engine == 'lowdim':
+        nn = LowDimNN(n_neighbors=k, metric=metric, **nn_params)
+    elif nn_engine == 'sklearn':
+        params = {'leaf_size': 50, 'algorithm': 'auto', 'metric': metric,
+                  'n_jobs': 10, **nn_params}
+        nn = NearestNeighbors(n_neighbors=k, **params)
+    elif nn_engine == 'brute':
+        nn = BruteForceNN(n_neighbors=k, metric=metric, **nn_params)
+    elif nn_engine == 'lsh':
+        nn = CauchyLSHNN(n_neighbors=k, metric=metric, **nn_params)
+    elif nn_engine == 'numba':
+        if numba is None:
+            warnings.warn('numba is not installed. Using nn_engine=brute.')
+            nn = BruteForceNN(n_neighbors=k)
+        else:
+            nn = NumbaNN(n_neighbors=k, **nn_params)
+    elif nn_engine == 'early_abandon':
+        if numba is None:
+            warnings.warn('numba is not installed. Using nn_engine=brute.')
+            nn = BruteForceNN(n_neighbors=k)
+        else:
+            if (weights is not None) and ('col_order' not in nn_params):
+                nn_params = {**nn_params,
+                             'col_order': np.argsort(-weights, kind='stable')}
+            nn = EarlyAbandonNN(n_neighbors=k, **nn_params)
+    else:
+        raise Exception(f'Nearest neighbor engine {nn_engine} not supported. '
+                        f'Supported engines are: auto, lowdim, sklearn, '
+                        f'brute, lsh, numba, and early_abandon.')
+    if dedup:
+        return DedupNN(nn, n_neighbors=k)
+    return nn
 
-def get_nn(X, T, treatment, k=None):
-    """Get the k nn of a particular treatment for each sample."""
-    nn = NearestNeighbors(n_neighbors=k, leaf_size=50, algorithm='auto',
-                          metric='cityblock', n_jobs=10).fit(X[T == treatment])
-    return nn.kneighbors(X, return_distance=True)
 
+def nn_recall(nn, X_ref, X_query, k, sample_size=1000, random_state=None,
+              metric='cityblock'):
+    """Measure the recall of an approximate nearest neighbor object.
 
-def convert_idx(mg, idx):
-    """Convert the index of the match groups back to the original idx."""
-    return pd.DataFrame(idx[mg.to_numpy()], index=idx)
+    Parameters
+    ----------
+    nn : nearest neighbor object
+        Nearest neighbor object already fit to X_ref.
+    X_ref : np.array
+        Reference samples nn was fit to.
+    X_query : np.array
+        Query samples. A random sample of sample_size rows is used.
+    k : int
+        Number of neighbors to compare.
+    sample_size : int, default=1000
+        Number of query samples to compute the exact neighbors for.
+    random_state : None or int, default=None
+        Random state used to sample the queries.
+    metric : str, default='cityblock'
+        Metric nn searches with. Either 'cityblock' or 'euclidean'.
+
+    Returns
+    -------
+    recall
+        Average fraction of each query's exact k nearest neighbors that nn
+        returned. Neighbors tied with the exact k-th distance count as found.
+    """
+    rng = np.random.default_rng(random_state)
+    if X_query.shape[0] > sample_size:
+        X_query = X_query[rng.choice(X_query.shape[0], sample_size,
+                                     replace=False)]
+    exact_dist, _ = BruteForceNN(n_neighbors=k, metric=metric).fit(
+        X_ref).kneighbors(X_query)
+    approx_dist, _ = nn.kneighbors(X_query, n_neighbors=k)
+    # squared euclidean distances from matrix products lose a few digits
+    kth_dist = exact_dist[:, [-1]] * (1 + (1e-10 if metric == 'cityblock'
+                                           else 1e-6))
+    found = np.minimum((approx_dist <= kth_dist).sum(axis=1), k)
+    return found.mean() / k
+
+
+class BruteForceNN:
+    """Exact nearest neighbors computed in memory bounded blocks.
+
+    Distances between a block of queries and a block of reference samples are
+    computed at once and the running top k of each query is updated with
+    np.argpartition. The block sizes are chosen so that each block of
+    distances fits in memory_budget bytes. Euclidean distances are ranked by
+    their squares ||a||^2 + ||b||^2 - 2ab^T, so each block is one BLAS matrix
+    product and the square root is only taken of the k returned distances.
+
+    Parameters
+    ----------
+    n_neighbors : int
+        Number of neighbors to return for each query.
+    memory_budget : int, default=2**25
+        Maximum number of bytes used by each block of distances.
+    ref_block_size : None or int, default=None
+        Number of reference samples per block. If None, set to 4096.
+    metric : str, default='cityblock'
+        Either 'cityblock' or 'euclidean'.
+    """
+    def __init__(self, n_neighbors=None, memory_budget=2**25,
+                 ref_block_size=None, metric='cityblock'):
+        self.n_neighbors = n_neighbors
+        self.memory_budget = memory_budget
+        self.ref_block_size = ref_block_size
+        self.metric = metric
+
+    def fit(self, X):
+        """Store the reference samples."""
+        if self.metric == 'euclidean':
+            self.X_ = float_array(X)
+            self.sq_norms_ = np.einsum('ij,ij->i', self.X_, self.X_)
+        elif self.metric == 'cityblock':
+            self.X_ = np.asarray(X)
+        else:
+            raise Exception(f'Metric {self.metric} not supported. Supported '
+                            f'metrics are: cityblock and euclidean.')
+        return self
+
+    def _block_dist(self, X, r_start, r_end):
+        """Get the distances (squared if euclidean) between the queries and
+        a block of reference samples."""
+        if self.metric == 'cityblock':
+            return cdist(X, self.X_[r_start:r_end], metric='cityblock')
+        sq_dist = X @ self.X_[r_start:r_end].T
+        sq_dist *= -2
+        sq_dist += np.einsum('ij,ij->i', X, X)[:, np.newaxis]
+        sq_dist += self.sq_norms_[r_start:r_end]
+        return np.maximum(sq_dist, 0, out=sq_dist)
+
+    def kneighbors(self, X, n_neighbors=None, return_distance=True):
+        """Get the n_neighbors nearest reference samples for each row of X."""
+        k = self.n_neighbors if n_neighbors is None else n_neighbors
+        X = np.asarray(X)
+        if self.metric == 'euclidean':
+            X = X.astype(self.X_.dtype, copy=False)
+        n_ref = self.X_.shape[0]
+        if k > n_ref:
+            raise ValueError(f'Expected n_neighbors <= n_samples_fit, but '
+                             f'n_samples_fit = {n_ref}, n_neighbors = {k}')
+        ref_block = min(n_ref, self.ref_block_size or 4096)
+        query_block = max(1, self.memory_budget // (8 * ref_block))
+        dist = np.empty((X.shape[0], k))
+        idx = np.empty((X.shape[0], k), dtype=np.intp)
+        for q_start in range(0, X.shape[0], query_block):
+            q_end = min(q_start + query_block, X.shape[0])
+            best_d = np.empty((q_end - q_start, 0))
+            best_i = np.empty((q_end - q_start, 0), dtype=np.intp)
+            for r_start in range(0, n_ref, ref_block):
+                r_end = min(r_start + ref_block, n_ref)
+                block_d = np.concatenate(
+                    [best_d, self._block_dist(X[q_start:q_end], r_start,
+                                              r_end)], axis=1)
+                block_i = np.concatenate(
+                    [best_i, np.broadcast_to(np.arange(r_start, r_end),
+                                             (q_end - q_start,
+                                              r_end - r_start))], axis=1)
+                if block_d.shape[1] > k:
+                    top = np.argpartition(block_d, k - 1, axis=1)[:, :k]
+                    block_d = np.take_along_axis(block_d, top, axis=1)
+                    block_i = np.take_along_axis(block_i, top, axis=1)
+                best_d, best_i = block_d, block_i
+            order = np.argsort(best_d, axis=1, kind='stable')
+            dist[q_start:q_end] = np.take_along_axis(best_d, order, axis=1)
+            idx[q_start:q_end] = np.take_along_axis(best_i, order, axis=1)
+        if self.metric == 'euclidean':
+            np.sqrt(dist, out=dist)
+        if return_distance:
+            return dist, idx
+        return idx
+
+
+class LowDimNN:
+    """Exact nearest neighbors specialised to one to three covariates.
+
+    With one covariate, the reference samples are sorted once and the k
+    nearest neighbors of a query are among the k sorted samples on either
+    side of its np.searchsorted position, so each query only ranks a window
+    of 2k candidates. With two or three covariates, a scipy cKDTree is
+    queried, which is far cheaper than a generic tree in so few dimensions.
+
+    Parameters
+    ----------
+    n_neighbors : int
+        Number of neighbors to return for each query.
+    metric : str, default='cityblock'
+        Either 'cityblock' or 'euclidean'.
+    memory_budget : int, default=2**25
+        Maximum number of bytes used by each block of candidate windows.
+    """
+    def __init__(self, n_neighbors=None, metric='cityblock',
+                 memory_budget=2**25):
+        self.n_neighbors = n_neighbors
+        self.metric = metric
+        self.memory_budget = memory_budget
+
+    def fit(self, X):
+        """Sort the reference samples or build a KD tree on them."""
+        self.X_ = np.asarray(X, dtype=np.float64)
+        if not 1 <= self.X_.shape[1] <= 3:
+            raise Exception(f'LowDimNN supports 1 to 3 covariates, not '
+                            f'{self.X_.shape[1]}.')
+        if self.metric not in ['cityblock', 'euclidean']:
+            raise Exception(f'Metric {self.metric} not supported. Supported '
+                            f'metrics are: cityblock and euclidean.')
+        if self.X_.shape[1] == 1:
+            self.order_ = np.argsort(self.X_[:, 0], kind='stable')
+            self.sorted_ = self.X_[self.order_, 0]
+        else:
+            self.tree_ = cKDTree(self.X_)
+        return self
+
+    def kneighbors(self, X, n_neighbors=None, return_distance=True):
+        """Get the n_neighbors nearest reference samples for each row of X."""
+        k = self.n_neighbors if n_neighbors is None else n_neighbors
+        n_ref = self.X_.shape[0]
+        if k > n_ref:
+            raise ValueError(f'Expected n_neighbors <= n_samples_fit, but '
+                             f'n_samples_fit = {n_ref}, n_neighbors = {k}')
+        X = np.asarray(X, dtype=np.float64)
+        if self.X_.shape[1] > 1:
+            dist, idx = self.tree_.query(
+                X, k=k, p=1 if self.metric == 'cityblock' else 2)
+            dist, idx = dist.reshape(-1, k), idx.reshape(-1, k)
+        else:
+            width = min(2 * k, n_ref)
+            chunk = max(1, self.memory_budget // (16 * width))
+            dist = np.empty((X.shape[0], k))
+            idx = np.empty((X.shape[0], k), dtype=np.intp)
+            for start in range(0, X.shape[0], chunk):
+                end = min(start + chunk, X.shape[0])
+                x = X[start:end, 0]
+                first = np.clip(np.searchsorted(self.sorted_, x) - k, 0,
+                                n_ref - width)
+                cands = first[:, np.newaxis] + np.arange(width)
+                cand_dist = np.abs(self.sorted_[cands] - x[:, np.newaxis])
+                cands = self.order_[cands]
+                top = np.lexsort((cands, cand_dist), axis=-1)[:, :k]
+                dist[start:end] = np.take_along_axis(cand_dist, top, axis=1)
+                idx[start:end] = np.take_along_axis(cands, top, axis=1)
+        if return_distance:
+            return dist, idx
+        return idx
+
+
+class NumbaNN:
+    """Exact cityblock nearest neighbors computed by a numba compiled kernel.
+
+    Queries are split across threads with numba.prange. For each query the
+    distance to every reference sample is accumulated in one pass over the
+    covariates and the k best are kept in a sorted buffer, so no distance
+    matrix is materialised.
+
+    Parameters
+    ----------
+    n_neighbors : int
+        Number of neighbors to return for each query.
+    """
+    def __init__(self, n_neighbors=None):
+        self.n_neighbors = n_neighbors
+
+    def fit(self, X):
+        """Store the reference samples."""
+        self.X_ = float_array(X)
+        return self
+
+    def kneighbors(self, X, n_neighbors=None, return_distance=True):
+        """Get the n_neighbors nearest reference samples for each row of X."""
+        k = self.n_neighbors if n_neighbors is None else n_neighbors
+        if k > self.X_.shape[0]:
+            raise ValueError(f'Expected n_neighbors <= n_samples_fit, but '
+                             f'n_samples_fit = {self.X_.shape[0]}, '
+                             f'n_neighbors = {k}')
+        dist, idx = _numba_l1_knn(
+            np.ascontiguousarray(X, dtype=self.X_.dtype), self.X_, k)
+        if return_distance:
+            return dist, idx
+        return idx
+
+
+class EarlyAbandonNN:
+    """Exact cityblock nearest neighbors that abandon a candidate as soon as
+    its partial distance exceeds the current k-th best distance.
+
+    Covariates are visited in col_order, so when a few covariates carry most
+    of the weight most candidates are abandoned after a few covariates.
+    Requires numba.
+
+    Parameters
+    ----------
+    n_neighbors : int
+        Number of neighbors to return for each query.
+    col_order : None or np.array, default=None
+        Order to visit the covariates in. Should put the covariates with the
+        largest weights first. If None, covariates are visited in order of
+        decreasing standard deviation of the reference samples.
+
+    Attributes
+    ----------
+    abandon_stats_ : dict
+        Counters accumulated over all kneighbors() calls since fit():
+        'candidates' is the number of query/reference pairs compared,
+        'column_ops' the number of covariate differences computed,
+        'full_column_ops' the number a full search would compute, and
+        'fraction_saved' the fraction of the covariate differences skipped.
+        get_match_groups() returns them in MatchGroups.abandon_stats.
+    """
+    def __init__(self, n_neighbors=None, col_order=None):
+        self.n_neighbors = n_neighbors
+        self.col_order = col_order
+
+    def fit(self, X):
+        """Store the reference samples with reordered covariates."""
+        X = float_array(X)
+        if self.col_order is None:
+            self.col_order_ = np.argsort(-X.std(axis=0), kind='stable')
+        else:
+            self.col_order_ = np.asarray(self.col_order)
+        self.X_ = np.ascontiguousarray(X[:, self.col_order_])
+        self.abandon_stats_ = {'candidates': 0, 'column_ops': 0,
+                               'full_column_ops': 0, 'fraction_saved': 0.0}
+        return self
+
+    def kneighbors(self, X, n_neighbors=None, return_distance=True):
+        """Get the n_neighbors nearest reference samples for each row of X."""
+        k = self.n_neighbors if n_neighbors is None else n_neighbors
+        if k > self.X_.shape[0]:
+            raise ValueError(f'Expected n_neighbors <= n_samples_fit, but '
+                             f'n_samples_fit = {self.X_.shape[0]}, '
+                             f'n_neighbors = {k}')
+        X = np.ascontiguousarray(
+            np.asarray(X, dtype=self.X_.dtype)[:, self.col_order_])
+        dist, idx, column_ops = _numba_l1_knn_abandon(X, self.X_, k)
+        stats = self.abandon_stats_
+        stats['candidates'] += X.shape[0] * self.X_.shape[0]
+        stats['column_ops'] += int(column_ops.sum())
+        stats['full_column_ops'] += X.shape[0] * self.X_.shape[0] * \
+            self.X_.shape[1]
+        stats['fraction_saved'] = 1 - (stats['column_ops'] /
+                                       max(stats['full_column_ops'], 1))
+        if return_distance:
+            return dist, idx
+        return idx
+
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _numba_l1_knn_abandon(X_query, X_ref, k):
+        """Cityblock k nearest neighbors of each query, abandoning each
+        candidate once its partial distance reaches the k-th best. Also
+        returns the number of covariate differences computed per query."""
+        n_query = X_query.shape[0]
+        n_ref, p = X_ref.shape
+        dist = np.empty((n_query, k))
+        idx = np.empty((n_query, k), dtype=np.int64)
+        column_ops = np.zeros(n_query, dtype=np.int64)
+        for i in numba.prange(n_query):
+            best_dist = np.full(k, np.inf)
+            best_idx = np.full(k, -1, dtype=np.int64)
+            ops = 0
+            for j in range(n_ref):
+                bound = best_dist[k - 1]
+                d = 0.0
+                c = 0
+                while (c < p) and (d < bound):
+                    d += abs(X_query[i, c] - X_ref[j, c])
+                    c += 1
+                ops += c
+                if d < bound:
+                    pos = k - 1
+                    while (pos > 0) and (best_dist[pos - 1] > d):
+                        best_dist[pos] = best_dist[pos - 1]
+                        best_idx[pos] = best_idx[pos - 1]
+                        pos -= 1
+                    best_dist[pos] = d
+                    best_idx[pos] = j
+            dist[i] = best_dist
+            idx[i] = best_idx
+            column_ops[i] = ops
+        return dist, idx, column_ops
+
+    @numba.njit(parallel=True, cache=True)
+    def _numba_l1_knn(X_query, X_ref, k):
+        """Cityblock k nearest neighbors of each query with a sorted buffer of
+        the k best reference samples per query."""
+        n_query = X_query.shape[0]
+        n_ref, p = X_ref.shape
+        dist = np.empty((n_query, k))
+        idx = np.empty((n_query, k), dtype=np.int64)
+        for i in numba.prange(n_query):
+            best_dist = np.full(k, np.inf)
+            best_idx = np.full(k, -1, dtype=np.int64)
+            for j in range(n_ref):
+                d = 0.0
+                for c in range(p):
+                    d += abs(X_query[i, c] - X_ref[j, c])
+                if d < best_dist[k - 1]:
+                    pos = k - 1
+                    while (pos > 0) and (best_dist[pos - 1] > d):
+                        best_dist[pos] = best_dist[pos - 1]
+                        best_idx[pos] = best_idx[pos - 1]
+                        pos -= 1
+                    best_dist[pos] = d
+                    best_idx[pos] = j
+            dist[i] = best_dist
+            idx[i] = best_idx
+        return dist, idx
+
+
+class CauchyLSHNN:
+    """Approximate cityblock nearest neighbors using a random projection
+    forest with Cauchy (1-stable) projections.
+
+    Each tree recursively splits the reference samples at the median of their
+    projection onto a random Cauchy direction until the leaves hold at most
+    2 * leaf_size samples. A query's candidates are the members of the leaf it
+    falls into in each tree and the candidates are re-ranked with their exact
+    cityblock distances. More trees or larger leaves trade speed for recall.
+    If metric='euclidean', Gaussian (2-stable) directions and euclidean
+    distances are used instead.
+
+    Parameters
+    ----------
+    n_neighbors : int
+        Number of neighbors to return for each query.
+    n_trees : int, default=8
+        Number of random projection trees.
+    leaf_size : None or int, default=None
+        Minimum number of reference samples in each leaf. If None, set to
+        4 * n_neighbors. The candidate budget of each query is roughly
+        n_trees * leaf_size.
+    target_recall : None or float, default=None
+        If float, trees are added while fitting until the recall measured by
+        nn_recall() on a sample of the reference samples reaches
+        target_recall or max_trees trees have been built.
+    max_trees : int, default=64
+        Maximum number of trees to build if target_recall is set.
+    memory_budget : int, default=2**25
+        Maximum number of bytes used by each block of candidate covariates
+        when re-ranking candidates.
+    random_state : None or int, default=None
+        Random state to run on.
+    metric : str, default='cityblock'
+        Either 'cityblock' or 'euclidean'.
+
+    Attributes
+    ----------
+    recall_ : None or float
+        Recall measured while fitting. Only set if target_recall is not None.
+    """
+    def __init__(self, n_neighbors=None, n_trees=8, leaf_size=None,
+                 target_recall=None, max_trees=64, memory_budget=2**25,
+                 random_state=None, metric='cityblock'):
+        self.n_neighbors = n_neighbors
+        self.n_trees = n_trees
+        self.leaf_size = leaf_size
+        self.target_recall = target_recall
+        self.max_trees = max_trees
+        self.memory_budget = memory_budget
+        self.random_state = random_state
+        self.metric = metric
+
+    def fit(self, X):
+        """Build the random projection forest on the reference samples."""
+        if self.metric not in ['cityblock', 'euclidean']:
+            raise Exception(f'Metric {self.metric} not supported. Supported '
+                            f'metrics are: cityblock and euclidean.')
+        self.X_ = np.asarray(X)
+        self.rng_ = np.random.default_rng(self.random_state)
+        leaf_size = max(self.leaf_size or 4 * self.n_neighbors,
+                        self.n_neighbors)
+        self.depth_ = int(max(0, np.floor(np.log2(
+            max(1, self.X_.shape[0] / leaf_size)))))
+        self.trees_ = [self._build_tree() for _ in range(self.n_trees)]
+        self.recall_ = None
+        if self.target_recall is not None:
+            self.recall_ = nn_recall(self, self.X_, self.X_, self.n_neighbors,
+                                     sample_size=256,
+                                     random_state=self.random_state,
+                                     metric=self.metric)
+            while (self.recall_ < self.target_recall) and \
+                    (len(self.trees_) < self.max_trees):
+                self.trees_ += [self._build_tree() for _ in
+                                range(min(len(self.trees_),
+                                          self.max_trees - len(self.trees_)))]
+                self.recall_ = nn_recall(self, self.X_, self.X_,
+                                         self.n_neighbors, sample_size=256,
+                                         random_state=self.random_state,
+                                         metric=self.metric)
+        return self
+
+    def _build_tree(self):
+        """Build one tree of median splits along random Cauchy (or Gaussian
+        if metric='euclidean') directions."""
+        n, p = self.X_.shape
+        node = np.zeros(n, dtype=np.intp)
+        directions, thresholds = [], []
+        draw = self.rng_.standard_cauchy if self.metric == 'cityblock' else \
+            self.rng_.standard_normal
+        for level in range(self.depth_):
+            these_dirs = draw(size=(2 ** level, p))
+            proj = np.einsum('ij,ij->i', self.X_, these_dirs[node])
+            order = np.lexsort((proj, node))
+            counts = np.bincount(node, minlength=2 ** level)
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            mid = starts + counts // 2
+            these_thresholds = proj[order][mid]
+            pos = np.empty(n, dtype=np.intp)
+            pos[order] = np.arange(n)
+            node = 2 * node + (pos >= mid[node])
+            directions.append(these_dirs)
+            thresholds.append(these_thresholds)
+        n_leaves = 2 ** self.depth_
+        counts = np.bincount(node, minlength=n_leaves)
+        order = np.argsort(node, kind='stable')
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        leaves = np.full((n_leaves, counts.max()), -1, dtype=np.intp)
+        cols = np.arange(n) - np.repeat(starts, counts)
+        leaves[node[order], cols] = order
+        return directions, thresholds, leaves
+
+    def _get_leaves(self, X, tree):
+        """Route each query to a leaf of a tree."""
+        directions, thresholds, leaves = tree
+        node = np.zeros(X.shape[0], dtype=np.intp)
+        for these_dirs, these_thresholds in zip(directions, thresholds):
+            proj = np.einsum('ij,ij->i', X, these_dirs[node])
+            node = 2 * node + (proj >= these_thresholds[node])
+        return leaves[node]
+
+    def kneighbors(self, X, n_neighbors=None, return_distance=True):
+        """Get the approximate n_neighbors nearest reference samples for each
+        row of X."""
+        k = self.n_neighbors if n_neighbors is None else n_neighbors
+        X = np.asarray(X)
+        if k > self.X_.shape[0]:
+            raise ValueError(f'Expected n_neighbors <= n_samples_fit, but '
+                             f'n_samples_fit = {self.X_.shape[0]}, '
+                             f'n_neighbors = {k}')
+        n_cands = sum(tree[2].shape[1] for tree in self.trees_)
+        chunk = max(1, self.memory_budget // (8 * n_cands * X.shape[1]))
+        dist = np.empty((X.shape[0], k))
+        idx = np.empty((X.shape[0], k), dtype=np.intp)
+        for start in range(0, X.shape[0], chunk):
+            end = min(start + chunk, X.shape[0])
+            cands = np.sort(np.concatenate(
+                [self._get_leaves(X[start:end], tree)
+                 for tree in self.trees_], axis=1), axis=1)
+            cand_diff = self.X_[cands] - X[start:end, np.newaxis, :]
+            if self.metric == 'cityblock':
+                cand_dist = np.abs(cand_diff).sum(axis=2)
+            else:
+                cand_dist = np.sqrt(np.einsum('ijk,ijk->ij', cand_diff,
+                                              cand_diff))
+            invalid = cands == -1
+            invalid[:, 1:] |= cands[:, 1:] == cands[:, :-1]
+            cand_dist[invalid] = np.inf
+            if k < cand_dist.shape[1]:
+                top = np.argpartition(cand_dist, k - 1, axis=1)[:, :k]
+            else:
+                top = np.broadcast_to(np.arange(k), (end - start, k))
+            these_dist = np.take_along_axis(cand_dist, top, axis=1)
+            these_idx = np.take_along_axis(cands, top, axis=1)
+            order = np.argsort(these_dist, axis=1, kind='stable')
+            dist[start:end] = np.take_along_axis(these_dist, order, axis=1)
+            idx[start:end] = np.take_along_axis(these_idx, order, axis=1)
+        if return_distance:
+            return dist, idx
+        return idx
+
+
+def unique_rows(X):
+    """Group identical rows of X.
+
+    Returns
+    -------
+    first
+        Row number of the first occurrence of each unique row.
+    inverse
+        For each row of X, the position of its unique row in first.
+    counts
+        Number of rows of X equal to each unique row.
+    """
+    X = np.ascontiguousarray(X) + 0.0
+    _, first, inverse, counts = np.unique(X, axis=0, return_index=True,
+                                          return_inverse=True,
+                                          return_counts=True)
+    return first, inverse.ravel(), counts
+
+
+class DedupNN:
+    """Nearest neighbors searched only among the unique reference and query
+    samples.
+
+    Identical rows (e.g. units that share every dummy covariate with a
+    nonzero weight) are collapsed to one representative before the wrapped
+    engine is fit or queried, so the index size and the number of queries
+    both shrink by the duplication factor. The neighbors of each unique query
+    are then expanded to the members of its nearest unique reference rows,
+    ranked by distance with ties broken by the lowest reference row number,
+    and broadcast back to every duplicate of the query.
+
+    Parameters
+    ----------
+    nn : nearest neighbor object
+        Unfitted nearest neighbor object that is fit to the unique rows.
+    n_neighbors : int
+        Number of neighbors to return for each query.
+    memory_budget : int, default=2**25
+        Maximum number of bytes used by each block of expanded candidates.
+    """
+    def __init__(self, nn, n_neighbors=None, memory_budget=2**25):
+        self.nn = nn
+        self.n_neighbors = n_neighbors
+        self.memory_budget = memory_budget
+
+    def fit(self, X):
+        """Fit the wrapped engine to the unique rows of X."""
+        X = np.asarray(X)
+        first, inverse, counts = unique_rows(X)
+        self.nn.fit(X[first])
+        self.n_samples_fit_ = X.shape[0]
+        self.members_ = np.argsort(inverse, kind='stable')
+        self.starts_ = np.cumsum(counts) - counts
+        self.counts_ = counts
+        return self
+
+    def kneighbors(self, X, n_neighbors=None, return_distance=True):
+        """Get the n_neighbors nearest reference samples for each row of X."""
+        k = self.n_neighbors if n_neighbors is None else n_neighbors
+        if k > self.n_samples_fit_:
+            raise ValueError(f'Expected n_neighbors <= n_samples_fit, but '
+                             f'n_samples_fit = {self.n_samples_fit_}, '
+                             f'n_neighbors = {k}')
+        X = np.asarray(X)
+        first, inverse, _ = unique_rows(X)
+        n_unique = min(k, self.counts_.shape[0])
+        u_dist, u_idx = self.nn.kneighbors(X[first], n_neighbors=n_unique,
+                                           return_distance=True)
+        # every unique reference row has at least one member, so the members
+        # of the n_unique nearest unique rows always include the k nearest
+        offsets = np.arange(min(k, self.counts_.max()))
+        chunk = max(1, self.memory_budget //
+                    (16 * n_unique * offsets.shape[0]))
+        dist = np.empty((first.shape[0], k))
+        idx = np.empty((first.shape[0], k), dtype=np.intp)
+        for start in range(0, first.shape[0], chunk):
+            end = min(start + chunk, first.shape[0])
+            these_idx = u_idx[start:end]
+            valid = offsets < self.counts_[these_idx][:, :, np.newaxis]
+            pos = self.starts_[these_idx][:, :, np.newaxis] + offsets
+            cands = self.members_[np.where(valid, pos, 0)].reshape(
+                end - start, -1)
+            cand_dist = np.where(valid, u_dist[start:end, :, np.newaxis],
+                                 np.inf).reshape(end - start, -1)
+            order = np.lexsort((cands, cand_dist), axis=-1)[:, :k]
+            dist[start:end] = np.take_along_axis(cand_dist, order, axis=1)
+            idx[start:end] = np.take_along_axis(cands, order, axis=1)
+        if return_distance:
+            return dist[inverse], idx[inverse]
+        return idx[inverse]
+
+
+def group_rows(labels):
+    """Get the unique labels and the row numbers of the samples with each
+    label."""
+    uniq, inverse = np.unique(labels, return_inverse=True)
+    inverse = inverse.ravel()
+    order = np.argsort(inverse, kind='stable')
+    return uniq, np.split(order, np.cumsum(np.bincount(inverse))[:-1])
+
+
+class BlockNN:
+    """Nearest neighbors restricted to the reference samples in the same
+    block.
+
+    A separate nearest neighbor object is fit to the reference samples of each
+    block and each query is only searched against its own block, so one
+    global search is replaced by many small independent ones that are run in
+    a thread pool. Every queried block must have at least n_neighbors
+    reference samples.
+
+    Parameters
+    ----------
+    n_neighbors : int
+        Number of neighbors to return for each query.
+    nn_engine : str, default='auto'
+        Nearest neighbor engine fit to each block. See config_nn() for
+        accepted values.
+    nn_params : None or dict, default=None
+        Additional parameters passed to the nearest neighbor engine.
+    weights : None or np.array, default=None
+        Weights of the covariates, passed to config_nn().
+    dedup : bool, default=False
+        Whether to only search the unique rows of each block. See DedupNN.
+    n_jobs : None or int, default=None
+        Number of threads used to fit and search the blocks.
+    metric : str, default='cityblock'
+        Distance between the covariates, passed to config_nn().
+    """
+    def __init__(self, n_neighbors=None, nn_engine='auto', nn_params=None,
+                 weights=None, dedup=False, n_jobs=None, metric='cityblock'):
+        self.n_neighbors = n_neighbors
+        self.nn_engine = nn_engine
+        self.nn_params = nn_params
+        self.weights = weights
+        self.dedup = dedup
+        self.n_jobs = n_jobs
+        self.metric = metric
+
+    def fit(self, X, blocks):
+        """Fit a nearest neighbor object to the samples of each block."""
+        X = np.asarray(X)
+        labels, rows = group_rows(blocks)
+        nns = Parallel(n_jobs=self.n_jobs, prefer='threads')(
+            delayed(config_nn(k=self.n_neighbors, nn_engine=self.nn_engine,
+                              nn_params=self.nn_params, weights=self.weights,
+                              dedup=self.dedup, metric=self.metric).fit)(
+                X[these_rows])
+            for these_rows in rows)
+        self.block_rows_ = dict(zip(labels, rows))
+        self.nn_ = dict(zip(labels, nns))
+        return self
+
+    def kneighbors(self, X, blocks, n_neighbors=None, return_distance=True):
+        """Get the n_neighbors nearest reference samples in the same block
+        for each row of X."""
+        k = self.n_neighbors if n_neighbors is None else n_neighbors
+        X = np.asarray(X)
+        labels, rows = group_rows(blocks)
+        small = [b for b in labels if (b not in self.block_rows_) or
+                 (self.block_rows_[b].shape[0] < k)]
+        if len(small) > 0:
+            raise Exception(f'Blocks {small} have fewer than {k} reference '
+                            f'samples to match to.')
+        results = Parallel(n_jobs=self.n_jobs, prefer='threads')(
+            delayed(self.nn_[b].kneighbors)(X[these_rows], n_neighbors=k,
+                                            return_distance=True)
+            for b, these_rows in zip(labels, rows))
+        dist = np.empty((X.shape[0], k))
+        idx = np.empty((X.shape[0], k), dtype=np.intp)
+        for b, these_rows, (this_dist, this_idx) in zip(labels, rows,
+                                                         results):
+            dist[these_rows] = this_dist
+            idx[these_rows] = self.block_rows_[b][this_idx]
+        if return_distance:
+            return dist, idx
+        return idx
 
 
 def get_CATES(df_estimation, match_groups, match_distances, outcome,
               covariates, M, method='mean', diameter_prune=None,
-              cov_imp_prune=0.01, check_est_df=True):
+              cov_imp_prune=0.01, check_est_df=True, df_reference=None,
+              k=None):
     """Calculate match groups for an estimation dataset.
 
     Parameters
     ----------
     df_estimation : pd.DataFrame
         Estimation dataset.
-    match_groups : pd.DataFrame
+    match_groups : MatchGroups or dict[int,pd.DataFrame]
         match groups for this df_estimation returned from get_match_groups().
-    match_distances : pd.DataFrame
-        match distances for this df_estimation returned from
-        get_match_groups().
+        Dictionaries of dataframes as returned by MatchGroups.to_frames(False)
+        are also accepted.
+    match_distances : None or dict[int,pd.DataFrame]
+        If match_groups is a dictionary, the accompanying match distances.
+        Ignored if match_groups is MatchGroups.
     outcome : str
         Outcome column label.
     covariates : list[str]
@@ -269,6 +2071,13 @@ def get_CATES(df_estimation, match_groups, match_distances, outcome,
     check_est_df : bool, default=True
         Whether to check the df_estimation for the appropriate columns
         before running.
+    df_reference : None or pd.DataFrame, default=None
+        If the match groups were created against a reference dataset, the
+        reference dataset. Matched outcomes and covariates are then taken
+        from df_reference and df_estimation does not need an outcome column.
+    k : None or int, default=None
+        If None, uses the full match groups. Otherwise, uses the first k
+        matches of each match group and appends _k{k} to the column names.
 
     Returns
     -------
@@ -276,56 +2085,418 @@ def get_CATES(df_estimation, match_groups, match_distances, outcome,
         Estimated CATE values for each sample in df_estimation.
     """
     if check_est_df:
-        check_df_estimation(df_cols=df_estimation.columns, necessary_cols=covariates + [outcome])
-    df_estimation, old_idx = check_mg_indices(df_estimation, match_groups,
-                                              match_distances)
+        if df_reference is None:
+            check_df_estimation(df_cols=df_estimation.columns,
+                                necessary_cols=covariates + [outcome])
+        else:
+            check_df_estimation(df_cols=df_estimation.columns,
+                                necessary_cols=covariates)
+            check_df_estimation(df_cols=df_reference.columns,
+                                necessary_cols=covariates + [outcome])
+    if not isinstance(match_groups, MatchGroups):
+        match_groups = MatchGroups.from_frames(match_groups, match_distances)
+    df_estimation, old_idx = check_mg_indices(df_estimation, match_groups)
+    if df_reference is None:
+        df_reference = df_estimation
+    X = X_ref = None
+    if 'linear' in method:
+        X = df_estimation[covariates].to_numpy(dtype=np.float64)
+        X_ref = X if df_reference is df_estimation else \
+            df_reference[covariates].to_numpy(dtype=np.float64)
+    return get_CATES_arrays(match_groups, df_reference[outcome].to_numpy(), M,
+                            method=method, diameter_prune=diameter_prune,
+                            cov_imp_prune=cov_imp_prune, X=X, X_ref=X_ref,
+                            k=k, index=old_idx)
+
+
+def get_CATES_arrays(match_groups, Y_ref, M, method='mean',
+                     diameter_prune=None, cov_imp_prune=0.01, X=None,
+                     X_ref=None, k=None, index=None):
+    """Calculate CATEs from match groups and arrays of samples. Array level
+    version of get_CATES().
+
+    Parameters
+    ----------
+    match_groups : MatchGroups
+        Match groups of the samples, e.g. from get_match_groups_arrays().
+    Y_ref : np.array
+        Outcomes of the reference samples the match groups refer to.
+    M : np.array or dict
+        Covariate weights. Only used if method == 'linear_pruned'.
+    method : str, default='mean'
+        CATE estimation method. Accepted values are 'mean', 'linear', and
+        'linear_pruned'.
+    diameter_prune : None or numeric, default=None
+        If numeric, prune all MGs for which the diameter is greater than
+        diameter_prune standard deviations from the mean match group
+        diameter.
+    cov_imp_prune : float, default=0.01
+        Minimum relative feature importance to not prune covariate. Only
+        used if method == 'linear_pruned'.
+    X : None or np.array, default=None
+        Covariates of the matched samples. Required by the linear methods.
+    X_ref : None or np.array, default=None
+        Covariates of the reference samples. If None, set to X.
+    k : None or int, default=None
+        If None, uses the full match groups. Otherwise, uses the first k
+        matches of each match group and appends _k{k} to the column names.
+    index : None or np.array, default=None
+        Index labels of the matched samples. If None, match_groups.index.
+
+    Returns
+    -------
+    cates
+        Dataframe with the estimated CATE values of each sample.
+    """
+    suffix = ''
+    if k is not None:
+        match_groups = match_groups.subset(k)
+        suffix = f'_k{k}'
+    old_idx = match_groups.index if index is None else np.asarray(index)
+    if ('linear' in method) and (X is None):
+        raise Exception(f'X must be passed to estimate CATEs with method '
+                        f'{method}.')
+    if X_ref is None:
+        X_ref = X
     potential_outcomes = []
-    for t, mgs in match_groups.items():
+    for t in match_groups.treatment_classes:
+        mgs = match_groups.groups[t]
         if diameter_prune:
-            diameters = match_distances[t].iloc[:, -1]
+            diameters = match_groups.diameters(t).astype(np.float64)
             good_mgs = diameters < (diameters.mean() +
-                                    (diameter_prune*diameters.std()))
-            these_mgs = mgs.loc[good_mgs].to_numpy()
+                                    (diameter_prune*diameters.std(ddof=1)))
+            these_mgs = mgs[good_mgs]
             mgs_idx = old_idx[good_mgs]
         else:
-            these_mgs = mgs.to_numpy()
+            these_mgs = mgs
             mgs_idx = old_idx
         if method == 'mean':
-            y_pot = df_estimation[outcome].to_numpy()[these_mgs].mean(axis=1)
+            y_pot = Y_ref[these_mgs].mean(axis=1)
         elif 'linear' in method:
             if 'pruned' in method:
                 if type(M) == dict:
                     weights = M[t]
                 else:
                     weights = M
-                imp_covs = prune_covariates(covariates, weights,
+                imp_covs = prune_covariates(list(range(X.shape[1])), weights,
                                             prune_level=cov_imp_prune)
             else:
-                imp_covs = covariates
-            these_mgs = df_estimation[imp_covs + [outcome]].to_numpy()[these_mgs]
-            these_samples = df_estimation[imp_covs].to_numpy()
+                imp_covs = list(range(X.shape[1]))
+            these_mgs = np.concatenate(
+                [X_ref[:, imp_covs], Y_ref[:, np.newaxis]], axis=1)[these_mgs]
+            these_samples = X[:, imp_covs]
             if diameter_prune:
                 these_samples = these_samples[good_mgs]
-            y_pot = [linear_cate(these_mgs[i], these_samples[i].reshape(1, -1))
-                     for i in range(these_samples.shape[0])]
+            y_pot = linear_cates(these_mgs, these_samples)
         else:
             raise Exception(f'CATE Method type {method} not supported. '
                             f'Supported methods are: mean, linear, and '
                             f'linear_pruned.')
+        potential_outcomes.append(pd.DataFrame(
+            y_pot, index=mgs_idx, columns=[f'Y{t}_{method}{suffix}']))
+    cates = pd.concat(potential_outcomes, axis=1).sort_index()
+    if len([t for t in match_groups.treatment_classes
+            if t not in [0, 1]]) == 0:
+        cates[f'CATE_{method}{suffix}'] = cates[f'Y1_{method}{suffix}'] - cates[f'Y0_{method}{suffix}']
+    else:
+        for t1, t2 in combinations(match_groups.treatment_classes, r=2):
+            cates[f'{t2}-{t1}_CATE_{method}{suffix}'] = cates[f'Y{t2}_{method}{suffix}'] - cates[f'Y{t1}_{method}{suffix}']
+    return cates
+
+
+def get_mean_CATES_streaming(df_estimation, covariates, treatment, outcome, M,
+                             k, diameter_prune=None, chunk_size=4096,
+                             check_est_df=True, nn_engine='auto',
+                             nn_params=None, df_reference=None, nn_index=None,
+                             dedup=False, block_on=None, n_jobs=None,
+                             metric='cityblock', dtype='float64'):
+    """Calculate 'mean' CATEs for an estimation dataset without storing the
+    match groups.
+
+    For each treatment class, the samples are matched in chunks of chunk_size
+    and each chunk's matched outcomes are averaged before the next chunk is
+    matched, so only O(chunk_size * k) matches are held in memory at once.
+    Returns the same estimates as get_CATES() with method='mean' run on the
+    output of get_match_groups().
+
+    Parameters
+    ----------
+    df_estimation : pd.DataFrame
+        Estimation dataset.
+    covariates : list[str]
+        Covariate names.
+    treatment : str
+        Treatment column label.
+    outcome : str
+        Outcome column label.
+    M : np.array or dict
+        Covariate weights. Must be in same order as covariates argument.
+    k : int
+        Match group size for each treatment.
+    diameter_prune : None or numeric, default=None
+        If numeric, prune all MGs for which the diameter is greater than
+        diameter_prune standard deviations from the mean match group
+        diameter.
+    chunk_size : int, default=4096
+        Number of samples to match at once.
+    check_est_df : bool, default=True
+        Whether to check the df_estimation for the appropriate columns
+        before running.
+    nn_engine : str, default='auto'
+        Nearest neighbor engine to use. See config_nn() for accepted values.
+    nn_params : None or dict, default=None
+        Additional parameters passed to the nearest neighbor engine.
+    df_reference : None or pd.DataFrame, default=None
+        If None, samples in df_estimation are matched to each other.
+        Otherwise, samples in df_estimation are matched to the samples in
+        df_reference and their outcomes are used.
+    nn_index : None or dict, default=None
+        Nearest neighbor objects already fit to each treatment class of
+        df_reference, as returned from build_nn_index().
+    dedup : bool, default=False
+        Whether to collapse identical weighted covariate rows before the
+        nearest neighbor search and broadcast the matches back to every
+        duplicate. See DedupNN.
+    block_on : None or str, default=None
+        If not None, label of a column with the block of each sample (e.g. a
+        site or school id). Samples are only matched to samples in the same
+        block, using a separate nearest neighbor object for each block. Every
+        block must have at least k samples of each treatment class.
+    n_jobs : None or int, default=None
+        Number of threads used to search the blocks. Only used if block_on is
+        not None.
+    metric : str, default='cityblock'
+        Distance between the weighted covariates. Either 'cityblock' or
+        'euclidean'. See config_nn().
+    dtype : str, default='float64'
+        Precision of the covariates used for matching. If 'float32', the
+        covariates, weighted covariates, and distances are kept in float32.
+        This halves the memory of the search itself only with
+        nn_engine='numba', 'early_abandon', or 'brute' with
+        metric='euclidean'. The sklearn tree, LowDimNN, and the cityblock
+        brute force search convert to float64 internally, so there only the
+        covariate matrices are halved. If 'int8', the covariates must be
+        integers between -128 and 127 (e.g. dummies) and are stored as int8
+        and weighted in float32.
+
+    Returns
+    -------
+    cates
+        Estimated CATE values for each sample in df_estimation.
+    """
+    block_cols = [] if block_on is None else [block_on]
+    if df_reference is None:
+        df_reference = df_estimation
+        if check_est_df:
+            check_df_estimation(df_cols=df_estimation.columns,
+                                necessary_cols=covariates + block_cols +
+                                [treatment, outcome])
+    elif check_est_df:
+        check_df_estimation(df_cols=df_estimation.columns,
+                            necessary_cols=covariates + block_cols)
+        check_df_estimation(df_cols=df_reference.columns,
+                            necessary_cols=covariates + block_cols +
+                            [treatment, outcome])
+    X = covariate_matrix(df_estimation, covariates, dtype)
+    blocks = None if block_on is None else df_estimation[block_on].to_numpy()
+    if df_reference is df_estimation:
+        return get_mean_CATES_streaming_arrays(
+            X, df_estimation[treatment].to_numpy(),
+            df_estimation[outcome].to_numpy(), M, k,
+            diameter_prune=diameter_prune, chunk_size=chunk_size,
+            index=df_estimation.index, nn_engine=nn_engine,
+            nn_params=nn_params, nn_index=nn_index, dedup=dedup,
+            blocks=blocks, n_jobs=n_jobs, metric=metric)
+    return get_mean_CATES_streaming_arrays(
+        X, None, None, M, k, diameter_prune=diameter_prune,
+        chunk_size=chunk_size, index=df_estimation.index,
+        X_ref=covariate_matrix(df_reference, covariates, dtype),
+        T_ref=df_reference[treatment].to_numpy(),
+        Y_ref=df_reference[outcome].to_numpy(), nn_engine=nn_engine,
+        nn_params=nn_params, nn_index=nn_index, dedup=dedup, blocks=blocks,
+        ref_blocks=(None if block_on is None else
+                    df_reference[block_on].to_numpy()),
+        n_jobs=n_jobs, metric=metric)
+
+
+def get_mean_CATES_streaming_arrays(X, T, Y, M, k, diameter_prune=None,
+                                    chunk_size=4096, index=None, X_ref=None,
+                                    T_ref=None, Y_ref=None, nn_engine='auto',
+                                    nn_params=None, nn_index=None,
+                                    dedup=False, blocks=None, ref_blocks=None,
+                                    n_jobs=None, metric='cityblock'):
+    """Calculate 'mean' CATEs for arrays of samples without storing the match
+    groups. Array level version of get_mean_CATES_streaming().
+
+    Parameters
+    ----------
+    X : np.array
+        Covariates of the samples to match, as returned by matching_array().
+    T : None or np.array
+        Treatments of the samples. Only needed if X_ref is None.
+    Y : None or np.array
+        Outcomes of the samples. Only needed if X_ref is None.
+    M : np.array or dict
+        Covariate weights. Must be in same order as the columns of X.
+    k : int
+        Match group size for each treatment.
+    diameter_prune : None or numeric, default=None
+        If numeric, prune all MGs for which the diameter is greater than
+        diameter_prune standard deviations from the mean match group
+        diameter.
+    chunk_size : int, default=4096
+        Number of samples to match at once.
+    index : None or np.array, default=None
+        Index labels of the samples. If None, their row numbers.
+    X_ref : None or np.array, default=None
+        If None, the samples are matched to each other. Otherwise, covariates
+        of the reference samples they are matched to.
+    T_ref : None or np.array, default=None
+        Treatments of the reference samples. Required with X_ref.
+    Y_ref : None or np.array, default=None
+        Outcomes of the reference samples. Required with X_ref.
+    nn_engine : str, default='auto'
+        Nearest neighbor engine to use. See config_nn() for accepted values.
+    nn_params : None or dict, default=None
+        Additional parameters passed to the nearest neighbor engine.
+    nn_index : None or dict, default=None
+        Nearest neighbor objects already fit to each treatment class of
+        X_ref, as returned from build_nn_index().
+    dedup : bool, default=False
+        Whether to collapse identical weighted covariate rows before the
+        nearest neighbor search. See DedupNN.
+    blocks : None or np.array, default=None
+        If not None, block of each sample. Samples are only matched to
+        reference samples in the same block. See BlockNN.
+    ref_blocks : None or np.array, default=None
+        Block of each reference sample. Required with blocks and X_ref.
+    n_jobs : None or int, default=None
+        Number of threads used to search the blocks.
+    metric : str, default='cityblock'
+        Distance between the weighted covariates. See config_nn().
+
+    Returns
+    -------
+    cates
+        Dataframe with the estimated CATE values of each sample.
+    """
+    old_idx = np.arange(X.shape[0]) if index is None else np.asarray(index)
+    if X_ref is None:
+        X_ref, T_ref, Y_ref, ref_blocks = X, T, Y, blocks
+    T_ref = np.asarray(T_ref)
+    Y_ref = np.asarray(Y_ref)
+    treatment_classes = list(np.unique(T_ref))
+    method = 'mean'
+    potential_outcomes = []
+    for t in treatment_classes:
+        weights = M[t] if type(M) == dict else M
+        if nn_index is not None:
+            nn = nn_index[t]
+        elif blocks is None:
+            nn = config_nn(k=k, nn_engine=nn_engine, nn_params=nn_params,
+                           weights=weights[weights > 0], dedup=dedup,
+                           metric=metric).fit(
+                weight_covariates(X_ref[T_ref == t], weights))
+        else:
+            nn = BlockNN(n_neighbors=k, nn_engine=nn_engine,
+                         nn_params=nn_params, weights=weights[weights > 0],
+                         dedup=dedup, n_jobs=n_jobs, metric=metric).fit(
+                weight_covariates(X_ref[T_ref == t], weights),
+                ref_blocks[T_ref == t])
+        this_Y = Y_ref[T_ref == t]
+        y_pot = np.empty(X.shape[0])
+        diameters = np.empty(X.shape[0])
+        for start in range(0, X.shape[0], chunk_size):
+            end = min(start + chunk_size, X.shape[0])
+            if blocks is None:
+                this_dist, this_mg = nn.kneighbors(
+                    weight_covariates(X[start:end], weights), n_neighbors=k,
+                    return_distance=True)
+            else:
+                this_dist, this_mg = nn.kneighbors(
+                    weight_covariates(X[start:end], weights),
+                    blocks[start:end], n_neighbors=k, return_distance=True)
+            y_pot[start:end] = this_Y[this_mg].mean(axis=1)
+            # rounded to float32 like the MatchGroups diameters pruned by
+            # get_CATES_arrays(), so both prune the same match groups
+            diameters[start:end] = this_dist[:, -1].astype(np.float32)
+        if diameter_prune:
+            good_mgs = diameters < (diameters.mean() +
+                                    (diameter_prune*diameters.std(ddof=1)))
+            y_pot = y_pot[good_mgs]
+            mgs_idx = old_idx[good_mgs]
+        else:
+            mgs_idx = old_idx
         potential_outcomes.append(pd.DataFrame(y_pot, index=mgs_idx,
                                                columns=[f'Y{t}_{method}']))
     cates = pd.concat(potential_outcomes, axis=1).sort_index()
-    if len([t for t in list(match_groups.keys()) if t not in [0, 1]]) == 0:
+    if len([t for t in treatment_classes if t not in [0, 1]]) == 0:
         cates[f'CATE_{method}'] = cates[f'Y1_{method}'] - cates[f'Y0_{method}']
     else:
-        for t1, t2 in combinations(list(match_groups.keys()), r=2):
+        for t1, t2 in combinations(treatment_classes, r=2):
             cates[f'{t2}-{t1}_CATE_{method}'] = cates[f'Y{t2}_{method}'] - cates[f'Y{t1}_{method}']
     return cates
 
 
 def linear_cate(mg, sample):
-    """Calculate CATE using a linear estiamtor inside the match group."""
-    return linear.RidgeCV().fit(mg[:, :-1], mg[:, -1]).predict(sample)[0]
+    """Calculate CATE using a linear estimator inside one match group. See
+    linear_cates()."""
+    return linear_cates(np.asarray(mg)[None],
+                        np.asarray(sample).reshape(1, -1))[0]
+
+
+def linear_cates(mgs, samples, alphas=(0.1, 1.0, 10.0), chunk_size=4096):
+    """Calculate CATEs using a linear estimator inside every match group at
+    once.
+
+    Equivalent to fitting sklearn's RidgeCV in each match group: a ridge
+    regression with an unpenalized intercept is fit in each match group and
+    the alpha is chosen by the closed form leave-one-out error, as done by
+    sklearn's RidgeCV. All match groups in a chunk are solved together with
+    a batched SVD.
+
+    Parameters
+    ----------
+    mgs : np.array
+        Array of shape (n, k, p + 1) with the covariates and, in the last
+        column, the outcome of the k matched samples of each of n samples.
+    samples : np.array
+        Array of shape (n, p) with the covariates of each sample.
+    alphas : tuple[float], default=(0.1, 1.0, 10.0)
+        Regularization strengths to choose from. Same as the RidgeCV default.
+    chunk_size : int, default=4096
+        Number of match groups to solve at once. Bounds memory usage.
+
+    Returns
+    -------
+    y_pot
+        Array of shape (n,) with the prediction for each sample.
+    """
+    y_pot = np.empty(mgs.shape[0])
+    k = mgs.shape[1]
+    for start in range(0, mgs.shape[0], chunk_size):
+        end = min(start + chunk_size, mgs.shape[0])
+        X = mgs[start:end, :, :-1].astype(np.float64)
+        y = mgs[start:end, :, -1].astype(np.float64)
+        X_mean = X.mean(axis=1, keepdims=True)
+        y_mean = y.mean(axis=1, keepdims=True)
+        U, sv, Vt = np.linalg.svd(X - X_mean, full_matrices=False)
+        Uty = np.einsum('bkr,bk->br', U, y - y_mean)
+        best_err = np.full(end - start, np.inf)
+        best_alpha = np.zeros(end - start)
+        for alpha in alphas:
+            shrink = sv ** 2 / (sv ** 2 + alpha)
+            resid = (y - y_mean) - np.einsum('bkr,br->bk', U, shrink * Uty)
+            hat_diag = (1 / k) + np.einsum('bkr,br->bk', U ** 2, shrink)
+            err = np.mean((resid / (1 - hat_diag)) ** 2, axis=1)
+            better = err < best_err
+            best_err[better] = err[better]
+            best_alpha[better] = alpha
+        coef = np.einsum('brp,br->bp', Vt,
+                         (sv / (sv ** 2 + best_alpha[:, np.newaxis])) * Uty)
+        y_pot[start:end] = y_mean[:, 0] + np.einsum(
+            'bp,bp->b', samples[start:end] - X_mean[:, 0], coef)
+    return y_pot
 
 
 def check_df_estimation(df_cols, necessary_cols):
@@ -335,21 +2506,20 @@ def check_df_estimation(df_cols, necessary_cols):
         raise Exception(f'df_estimation missing necessary column(s) {missing_cols}')
 
 
-def check_mg_indices(df_estimation, match_groups, match_distances):
-    """Check that all the samples in a match groups dataframe are in
+def check_mg_indices(df_estimation, match_groups):
+    """Check that all the samples in a MatchGroups object are in
     the estimation dataframe."""
-    old_idx = df_estimation.index
+    old_idx = np.array(df_estimation.index)
     df_estimation = df_estimation.reset_index(drop=True)
     est_nrows = df_estimation.shape[0]
-    if not np.all([len(mg) == est_nrows for mg in match_groups.values()]):
+    if not np.all([len(mg) == est_nrows
+                   for mg in match_groups.groups.values()]):
+        raise Exception(
+            f'Match group sizes do not match size of df_estimation')
+    if not np.all([len(md) == est_nrows
+                   for md in match_groups.distances.values()]):
         raise Exception(
-            f'Match group dataframe sizes do not match size of df_estimation')
-    if match_distances is not None:
-        if not np.all([len(mg) == est_nrows for mg in
-                       match_distances.values()]):
-            raise Exception(
-                f'Match distances dataframe sizes do not match size of '
-                f'df_estimation')
+            f'Match distances sizes do not match size of df_estimation')
     return df_estimation, old_idx
 
 